@@ -0,0 +1,100 @@
+"""Time the per node cost of rendering a document with 100,000 spans.
+
+htmlise() runs each node's Opcode, with its tags made when the opcodes are
+built, on the first render and again whenever tag_funcs or lookups change.
+For comparison, `lookup_emit_node` below renders the same way the renderer
+did before that, looking the node up in tag_funcs and then lookups and
+formatting its tags again for every node.
+
+Run from the repository root with::
+
+    python -m benchmarks.dispatch
+"""
+
+from __future__ import print_function
+
+import timeit
+
+import markdown3
+
+SPANS = [
+    ['plain', "Some text "],
+    ['emphasis', "some bold"],
+    ['plain', " and "],
+    ['code', "some code"],
+    ['link', ['link_text', "a link"], ['link_url', "http://www.google.com"]],
+    ]
+
+def span_document(spans=100000, per_paragraph=50):
+    paragraphs = []
+    for _ in range(spans // per_paragraph):
+        paragraph = ['paragraph']
+        for i in range(per_paragraph):
+            paragraph.append(SPANS[i % len(SPANS)])
+        paragraphs.append(paragraph)
+    return ['body'] + paragraphs
+
+def count_nodes(tree):
+    if isinstance(tree, basestring):
+        return 0
+    return 1 + sum(count_nodes(item) for item in tree[1:])
+
+def _lookup_span(head, rest, emit, indent):
+    tag = markdown3.lookups[head]
+    if tag:
+        start_tag = "<%s>" % tag
+        end_tag = "</%s>" % tag
+    else:
+        start_tag = ""
+        end_tag = ""
+    lines = []
+    for item in rest:
+        lookup_emit_node(item, lines.append)
+    emit("%s%s%s%s" % (indent, start_tag, "".join(lines), end_tag))
+
+def _lookup_span_with_linebreak(head, rest, emit, indent):
+    _lookup_span(head, rest, emit, indent)
+    emit(indent)
+
+def _lookup_tagless(head, rest, emit, indent):
+    for item in rest:
+        lookup_emit_node(item, emit, indent)
+
+def _lookup_anchor(head, rest, emit, indent):
+    lines = []
+    lookup_emit_node(rest[0], lines.append)
+    emit('%s<a href="%s">%s</a>' % (indent, rest[1][1], "".join(lines)))
+
+_lookup_emitters = {
+    markdown3.make_span: _lookup_span,
+    markdown3.make_span_with_linebreak: _lookup_span_with_linebreak,
+    markdown3.make_tagless: _lookup_tagless,
+    markdown3.make_anchor: _lookup_anchor,
+    }
+
+def lookup_emit_node(data, emit, indent=""):
+    if isinstance(data, basestring):
+        emit(indent + data)
+        return
+    head, rest = data[0], data[1:]
+    func = markdown3.tag_funcs[head]
+    _lookup_emitters[func](head, rest, emit, indent)
+
+def lookup_htmlise(tree):
+    lines = []
+    lookup_emit_node(tree, lines.append)
+    return "\n".join(lines)
+
+def main(repeat=10):
+    tree = span_document()
+    nodes = count_nodes(tree)
+    assert lookup_htmlise(tree) == markdown3.htmlise(tree)
+    print("%10s %10s %10s" % ("dispatch", "seconds", "ns/node"))
+    for name, func in [("lookup", lookup_htmlise),
+                       ("opcode", markdown3.htmlise)]:
+        seconds = min(timeit.repeat(
+            lambda: func(tree), number=1, repeat=repeat))
+        print("%10s %10.4f %10.1f" % (name, seconds, seconds * 1e9 / nodes))
+
+if __name__ == '__main__':
+    main()
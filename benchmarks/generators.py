@@ -0,0 +1,117 @@
+"""Synthetic markdown documents for the benchmarks.
+
+Each generator takes a `size`, the number of times its construct is
+repeated, and returns markdown text.  The list generators also take the
+`depth` lists are nested to.
+"""
+
+PARAGRAPH = ("A paragraph with *some bold*, `some code` and "
+             "[a link to Google](http://www.google.com) in it.")
+
+def paragraphs(size):
+    return "\n\n".join([PARAGRAPH] * size) + "\n"
+
+def plain_paragraphs(size):
+    return "\n\n".join(["A plain paragraph, with nothing else in it."] * size) + "\n"
+
+def emphasis(size):
+    return "\n\n".join(["Text with *some bold* in it"] * size) + "\n"
+
+def links(size):
+    return "\n\n".join(
+        ["Text with [a link to Google](http://www.google.com) in it"] * size) + "\n"
+
+def code_spans(size):
+    return "\n\n".join(["Text with `some code` in it"] * size) + "\n"
+
+def titles_level_1(size):
+    return "\n\n".join(["# A level one title #"] * size) + "\n"
+
+def titles_level_2(size):
+    return "\n\n".join(["## A level two title ##"] * size) + "\n"
+
+def code_blocks(size):
+    return "\n\n".join(
+        ["    <p>This is some html</p>"] * size) + "\n"
+
+def horizontal_rules(size):
+    return "\n\n".join(["---", "- - -", "***", "_ _ _"] * size) + "\n"
+
+def blockquotes(size):
+    return "\n\n".join(["> A quoted paragraph"] * size) + "\n"
+
+def _bullets(bullet, size, indent=""):
+    return ["%s%s A bullet with *bold* and `code`" % (
+        indent, bullet(i)) for i in range(1, size + 1)]
+
+def _numbered(i):
+    return "%d." % i
+
+def _starred(i):
+    return "*"
+
+def ordered_list(size):
+    return "\n".join(_bullets(_numbered, size)) + "\n"
+
+def unordered_list(size):
+    return "\n".join(_bullets(_starred, size)) + "\n"
+
+def ordered_list_with_paragraphs(size):
+    return "\n\n".join(_bullets(_numbered, size)) + "\n"
+
+def unordered_list_with_paragraphs(size):
+    return "\n\n".join(_bullets(_starred, size)) + "\n"
+
+def _nested(size, depth, bullet_for_level):
+    lines = []
+    for i in range(1, size + 1):
+        for level in range(depth):
+            lines.append("%s%s A bullet at depth %d" % (
+                "  " * level, bullet_for_level(level)(i), level))
+    return "\n".join(lines) + "\n"
+
+def nested_ordered_list(size, depth=4):
+    return _nested(size, depth, lambda level: _numbered)
+
+def nested_unordered_list(size, depth=4):
+    return _nested(size, depth, lambda level: _starred)
+
+def nested_mixed_list(size, depth=4):
+    return _nested(
+        size, depth, lambda level: _starred if level % 2 else _numbered)
+
+def document(size):
+    return "\n".join([
+        "# A Header",
+        "",
+        "## A SubHeader ##",
+        "",
+        paragraphs(size),
+        "---",
+        "",
+        nested_mixed_list(max(1, size // 4), depth=3),
+        "  A code block with <span>some html</span> in it.",
+        "",
+        "> A quoted paragraph",
+        ""])
+
+constructs = [
+    ('paragraph', paragraphs),
+    ('plain', plain_paragraphs),
+    ('emphasis', emphasis),
+    ('link', links),
+    ('code', code_spans),
+    ('title_level_1', titles_level_1),
+    ('title_level_2', titles_level_2),
+    ('code_block', code_blocks),
+    ('horizontal_rule', horizontal_rules),
+    ('blockquote', blockquotes),
+    ('ordered_list', ordered_list),
+    ('unordered_list', unordered_list),
+    ('ordered_list_with_paragraphs', ordered_list_with_paragraphs),
+    ('unordered_list_with_paragraphs', unordered_list_with_paragraphs),
+    ('nested_ordered_list', nested_ordered_list),
+    ('nested_unordered_list', nested_unordered_list),
+    ('nested_mixed_list', nested_mixed_list),
+    ('document', document),
+    ]
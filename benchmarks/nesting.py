@@ -0,0 +1,44 @@
+"""Time htmlise() on nested lists of increasing depth.
+
+Every document renders roughly the same number of bullets, spread over
+lists nested `depth` levels deep, so if rendering is linear in the size
+of the output the time per output byte stays flat as the depth grows.
+
+Run from the repository root with::
+
+    python -m benchmarks.nesting
+"""
+
+from __future__ import print_function
+
+import timeit
+
+import markdown3
+
+def nested_list(depth, bullets, kind='unordered_list'):
+    items = [
+        ['bullet_without_paragraph',
+         ['plain', "A bullet at depth %s" % depth]]
+        for _ in range(bullets)]
+    if depth > 1:
+        items.append(nested_list(depth - 1, bullets, kind))
+    return [kind] + items
+
+def nested_document(depth, total_bullets=12000):
+    per_list = max(1, total_bullets // depth)
+    return ['body',
+            nested_list(depth, per_list, 'unordered_list'),
+            nested_list(depth, per_list, 'ordered_list')]
+
+def main(depths=(1, 2, 4, 8, 12, 16, 32, 64), repeat=3):
+    print("%6s %12s %10s %12s" % ("depth", "bytes", "seconds", "ns/byte"))
+    for depth in depths:
+        tree = nested_document(depth)
+        size = len(markdown3.htmlise(tree))
+        seconds = min(timeit.repeat(
+            lambda: markdown3.htmlise(tree), number=1, repeat=repeat))
+        print("%6d %12d %10.4f %12.1f" % (
+            depth, size, seconds, seconds * 1e9 / size))
+
+if __name__ == '__main__':
+    main()
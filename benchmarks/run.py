@@ -0,0 +1,202 @@
+"""Time parse() and htmlise() for every construct in benchmarks.generators.
+
+For each construct and size this reports the throughput of parsing and of
+rendering separately, of the fused parse and render of to_html(fused=True)
+and of parsing into Nodes with parse(typed=True), in bytes of markdown per
+second, along with the peak memory each of them allocated.  That comes from
+tracemalloc where there is one, and otherwise from how far running the
+phase again in a new process takes its maximum resident set size.  Results
+can be saved as a baseline and later runs compared against it; any
+throughput that has dropped by more than the threshold is reported as a
+regression and the run exits with a non-zero status.
+
+Run from the repository root with, e.g.::
+
+    python -m benchmarks.run --save baseline.json
+    python -m benchmarks.run --compare baseline.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import marshal
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+import traceback
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import markdown3
+
+from benchmarks import generators
+
+calls = {
+    'parse': lambda text, tree: markdown3.parse(text),
+    'htmlise': lambda text, tree: markdown3.htmlise(tree),
+    'fused': lambda text, tree: markdown3.to_html(text, fused=True),
+    'typed': lambda text, tree: markdown3.parse(text, typed=True),
+    }
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def peak_memory(phase, text, tree):
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            calls[phase](text, tree)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    if resource is None:
+        return None
+    # Only hand over what the phase uses, so that loading it doesn't set a
+    # peak that the phase itself never reaches.
+    if phase == 'htmlise':
+        text = None
+    else:
+        tree = None
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump((text, tree), f)
+        output = subprocess.check_output(
+            [sys.executable, '-m', 'benchmarks.run', '--peak-memory', phase,
+             path], cwd=root)
+    finally:
+        os.remove(path)
+    return int(output)
+
+def max_rss():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux counts in kilobytes, macOS in bytes.
+    if sys.platform == 'darwin':
+        return usage
+    return usage * 1024
+
+def print_peak_memory(phase, path):
+    with open(path, 'rb') as f:
+        text, tree = marshal.load(f)
+    # A process starts out with the maximum of the one that ran it, but a
+    # forked one with only what it shares with its parent.
+    pid = os.fork()
+    if pid:
+        return 1 if os.waitpid(pid, 0)[1] else 0
+    try:
+        before = max_rss()
+        calls[phase](text, tree)
+        print(max_rss() - before)
+        sys.stdout.flush()
+    except Exception:
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(0)
+
+def measure(phase, text, tree, repeat):
+    seconds = min(timeit.repeat(
+        lambda: calls[phase](text, tree), number=1, repeat=repeat))
+    return {
+        'seconds': seconds,
+        'throughput': len(text) / seconds if seconds else float('inf'),
+        'peak_memory': peak_memory(phase, text, tree),
+        }
+
+def run(sizes, repeat, only=None):
+    results = {}
+    for name, generator in generators.constructs:
+        if only and name not in only:
+            continue
+        for size in sizes:
+            text = generator(size)
+            tree = markdown3.parse(text)
+            key = "%s/%s" % (name, size)
+            results[key] = {'bytes': len(text)}
+            for phase in phases:
+                results[key][phase] = measure(phase, text, tree, repeat)
+            report(key, results[key])
+    return results
+
+def format_memory(value):
+    if value is None:
+        return "-"
+    return "%.1fK" % (value / 1024.0)
+
+phases = ('parse', 'htmlise', 'fused', 'typed')
+
+def report(key, result):
+    columns = [key, result['bytes']]
+    for phase in phases:
+        columns.append(result[phase]['throughput'])
+        columns.append(format_memory(result[phase]['peak_memory']))
+    print(("%-40s %9d" + " %12.0f %9s" * len(phases)) % tuple(columns))
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        for phase in phases:
+            if phase not in baseline[key]:
+                continue
+            before = baseline[key][phase]['throughput']
+            after = result[phase]['throughput']
+            if after < before * (1 - threshold):
+                regressions.append((key, phase, before, after))
+    for key, phase, before, after in regressions:
+        print("REGRESSION %s %s: %.0f -> %.0f bytes/sec (%.0f%%)" % (
+            key, phase, before, after, 100.0 * (after - before) / before))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sizes', default="10,100,1000",
+        help="comma separated numbers of repetitions of each construct")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--only', action='append',
+        help="only run the named construct (may be given more than once)")
+    parser.add_argument('--save', help="write the results to this file")
+    parser.add_argument(
+        '--compare', help="compare the results with a saved baseline")
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help="fractional drop in throughput reported as a regression")
+    parser.add_argument(
+        '--peak-memory', nargs=2, metavar=('PHASE', 'PATH'),
+        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.peak_memory:
+        return print_peak_memory(*args.peak_memory)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    headings = ["construct/size", "bytes"]
+    for phase in phases:
+        headings.extend([phase + " B/s", "peak"])
+    print(("%-40s %9s" + " %12s %9s" * len(phases)) % tuple(headings))
+    results = run(sizes, args.repeat, args.only)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,44 @@
+"""Time a cold start: importing markdown3 and converting one small document.
+
+Each measurement runs in a fresh interpreter, `repeat` times, reporting the
+fastest.  The time to start an interpreter that does nothing is taken off,
+so what is left is the cost of markdown3 itself.  pegger, the grammar and
+the tables built from it are only loaded or made when they are first
+used, so most of the cost of a cold start is in the first render.
+
+Compile the modules first, and leave PYTHONDONTWRITEBYTECODE unset, or
+every run will include recompiling markdown3.
+
+Run from the repository root with::
+
+    python -m benchmarks.startup
+"""
+
+from __future__ import print_function
+
+import subprocess
+import sys
+import timeit
+
+IMPORT = "import markdown3"
+
+FIRST_RENDER = IMPORT + "; markdown3.to_html('Hello *World*')"
+
+def cold_start(code, repeat):
+    times = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        subprocess.check_call([sys.executable, "-c", code])
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+def main(repeat=20):
+    interpreter = cold_start("pass", repeat)
+    print("%-34s %10s" % ("", "ms"))
+    for name, code in [("import", IMPORT),
+                       ("import and first render", FIRST_RENDER)]:
+        seconds = cold_start(code, repeat) - interpreter
+        print("%-34s %10.2f" % (name, seconds * 1e3))
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,95 @@
 # -*- coding: utf-8 -*-
 
+import bisect
+import collections
+import contextlib
+import functools
+import marshal
+import os
+import re
 import string
+import sys
+import thread
+import timeit
+import types
 
-import pegger as pg
+# argparse, glob, hashlib, json, logging, multiprocessing and tempfile are
+# only imported by the functions that need them, and pegger by
+# _load_pegger(), which keeps importing markdown3 itself quick.  For the
+# same reason locks and thread-local state come from thread rather than
+# threading.
 
+__version__ = '0.1'
+
+class _LazyPegger(object):
+    # Stands in for pegger until something is wanted from it, when
+    # _load_pegger() imports it and puts it in its place.
+
+    def __getattr__(self, name):
+        return getattr(_load_pegger(), name)
+
+pg = _LazyPegger()
+_pegger_do_parse = None
+_pegger_lock = thread.allocate_lock()
+
+def _load_pegger():
+    global pg, _pegger_do_parse
+    if isinstance(pg, _LazyPegger):
+        with _pegger_lock:
+            if isinstance(pg, _LazyPegger):
+                import pegger
+                _pegger_do_parse = pegger.do_parse
+                pg = pegger
+    return pg
+
+class _Regex(object):
+    # A regular expression that is only compiled once it is first used.
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __getattr__(self, name):
+        compiled = re.compile(self.pattern, self.flags)
+        self.match = compiled.match
+        self.search = compiled.search
+        return getattr(compiled, name)
+
+_grammar = {}
+rules = []
+
+def rule(func):
+    """Build the pattern for `func` once and share it between parses."""
+    @functools.wraps(func)
+    def compiled_rule():
+        try:
+            return _grammar[func]
+        except KeyError:
+            return _grammar.setdefault(func, func())
+    compiled_rule.__wrapped__ = func
+    rules.append(compiled_rule)
+    return compiled_rule
+
+@rule
 def body():
-    return pg.Many(
-        linebreaks,
-        horizontal_rule,
-        title_level_2,
-        title_level_1,
-        ordered_list,
-        unordered_list,
-        code_block,
-        paragraph,
-        blockquote,
-        )
+    return pg.Many(*blocks)
 
+@rule
 def plain():
     return pg.Words(string.lowercase+string.uppercase+string.digits+"., :")
 
+@rule
 def emphasis():
     return pg.AllOf(
         pg.Ignore('*'),
         pg.Words(),
         pg.Ignore('*'))
 
+@rule
 def link():
     return pg.AllOf(link_text, link_url)
 
+@rule
 def link_text():
     return pg.AllOf(
         pg.Ignore("["),
@@ -37,6 +98,7 @@ def link_text():
                 pg.Not("]"))),
         pg.Ignore("]"))
 
+@rule
 def link_url():
     return pg.AllOf(
         pg.Ignore("("),
@@ -45,6 +107,7 @@ def link_url():
                 pg.Not(")"))),
         pg.Ignore(")"))
 
+@rule
 def code():
     return pg.AllOf(
         pg.Ignore("`"),
@@ -53,13 +116,17 @@ def code():
                 pg.Not("`"))),
         pg.Ignore("`"))
 
+@rule
 def paragraph():
     return pg.AllOf(
-        span_text)
+        _span_text)
 
-linebreaks = pg.Ignore(
-    pg.Many("\n"))
+@rule
+def _linebreaks():
+    return pg.Ignore(
+        pg.Many("\n"))
 
+@rule
 def title_level_1():
     return pg.AllOf(
         pg.Ignore("# "),
@@ -70,6 +137,7 @@ def title_level_1():
                 pg.Optional("#"),
                 "\n")))
 
+@rule
 def title_level_2():
     return pg.AllOf(
         pg.Ignore("## "),
@@ -80,9 +148,11 @@ def title_level_2():
                 pg.Optional("##"),
                 "\n")))
 
+@rule
 def digits():
     return pg.Words(letters="1234567890")
 
+@rule
 def ordered_list():
     return pg.OneOf(
         _ordered_list_without_paragraphs,
@@ -90,6 +160,7 @@ def ordered_list():
         _ordered_list_with_single_bullet
         )
 
+@rule
 def ordered_list_nested():
     return pg.OneOf(
         _ordered_list_without_paragraphs_nested,
@@ -97,25 +168,27 @@ def ordered_list_nested():
         _ordered_list_with_single_bullet_nested,
         )
 
+@rule
 def numbered_bullet_without_paragraph():
     return pg.AllOf(
         pg.Ignore(digits),
         pg.Ignore("."),
         pg.Ignore(
             pg.OneOf(" ", "\t")),
-        span_text)
+        _span_text)
 
+@rule
 def numbered_bullet_with_paragraph():
     return pg.Indented(
         pg.AllOf(
             paragraph,
             pg.Optional(
                 pg.AllOf(
-                    linebreaks,
+                    _linebreaks,
                     paragraph))),
         initial_indent=pg.AllOf(
             pg.Optional(
-                linebreaks),
+                _linebreaks),
             pg.OneOf(
                 pg.AllOf(
                     pg.Ignore(digits),
@@ -126,11 +199,13 @@ def numbered_bullet_with_paragraph():
                     ".",
                     " "))))
 
+@rule
 def _ordered_list_with_single_bullet():
     return pg.Indented(
         numbered_bullet_without_paragraph,
         optional=True)
 
+@rule
 def _ordered_list_with_single_bullet_nested():
     return pg.Indented(
         numbered_bullet_without_paragraph,
@@ -150,28 +225,33 @@ def _ordered_list_template(bullet_type, spacing, optional=True):
                         unordered_list)))),
         optional=optional)
 
+@rule
 def _ordered_list_without_paragraphs():
     return _ordered_list_template(
         bullet_type=numbered_bullet_without_paragraph,
         spacing="\n")
 
+@rule
 def _ordered_list_without_paragraphs_nested():
     return _ordered_list_template(
         bullet_type=numbered_bullet_without_paragraph,
         spacing="\n",
         optional=False)
 
+@rule
 def _ordered_list_with_paragraphs():
     return _ordered_list_template(
         bullet_type=numbered_bullet_with_paragraph,
         spacing="\n\n")
 
+@rule
 def _ordered_list_with_paragraphs_nested():
     return _ordered_list_template(
         bullet_type=numbered_bullet_with_paragraph,
         spacing="\n\n",
         optional=False)
 
+@rule
 def unordered_list():
     return pg.OneOf(
         _unordered_list_without_paragraphs,
@@ -179,6 +259,7 @@ def unordered_list():
         _unordered_list_with_single_bullet
         )
 
+@rule
 def _unordered_list_with_single_bullet():
     return pg.Indented(
         bullet_without_paragraph,
@@ -198,24 +279,28 @@ def _unordered_list_template(bullet_type, spacing):
                         ordered_list)))),
         optional=True)
 
+@rule
 def _unordered_list_without_paragraphs():
     return _unordered_list_template(
         bullet_type=bullet_without_paragraph,
         spacing="\n")
 
+@rule
 def _unordered_list_with_paragraphs():
     return _ordered_list_template(
         bullet_type=bullet_with_paragraph,
         spacing="\n\n")
 
+@rule
 def bullet_without_paragraph():
     return pg.AllOf(
         pg.Ignore(
             pg.OneOf("*", "+", "-")),
         pg.Ignore(
             pg.OneOf(" ", "\t")),
-        span_text)
+        _span_text)
 
+@rule
 def bullet_with_paragraph():
     return pg.AllOf(
         pg.Ignore(
@@ -224,30 +309,37 @@ def bullet_with_paragraph():
             pg.OneOf(" ", "\t")),
         paragraph)
 
-span_text = pg.Many(
-    plain,
-    emphasis,
-    link,
-    code)
+@rule
+def _span_text():
+    return pg.Many(
+        plain,
+        emphasis,
+        link,
+        code)
 
+@rule
 def code_line():
     return pg.Escaped(
         pg.Join(
             pg.Many(
                 pg.Not("\n"))))
 
-code_paragraph = pg.AllOf(
-    pg.Ignore(
-        pg.Optional(
-            pg.Many("\n"))),
-    pg.Many(
-        code_line))
+@rule
+def _code_paragraph():
+    return pg.AllOf(
+        pg.Ignore(
+            pg.Optional(
+                pg.Many("\n"))),
+        pg.Many(
+            code_line))
 
+@rule
 def code_block():
     return pg.AllOf(
         pg.Indented(
-            code_paragraph))
+            _code_paragraph))
 
+@rule
 def horizontal_rule():
     return pg.AllOf(
         pg.OneOf(
@@ -262,12 +354,328 @@ def horizontal_rule():
                 pg.Many(
                     pg.Not("\n")))))
 
+@rule
 def blockquote():
     return pg.AllOf(
         pg.Ignore('> '),
         paragraph
         )
 
+# The alternatives body tries, in order, at the start of every block.
+blocks = (
+    _linebreaks,
+    horizontal_rule,
+    title_level_2,
+    title_level_1,
+    ordered_list,
+    unordered_list,
+    code_block,
+    paragraph,
+    blockquote,
+    )
+
+
+# Most of a document is inline text, which _span_text would otherwise match
+# by trying each of its alternatives in turn at every position.  The
+# scanners below match the common cases with a single regular expression
+# instead, and give up (returning None) on anything that needs the full
+# rules, such as a link or code span running over several lines.
+
+_inline_token = _Regex(r"""
+      (?P<plain>[a-zA-Z0-9., :]+)
+    | \*(?P<emphasis>[a-zA-Z ]+)\*
+    | \[(?P<link_text>[^\]\n]+)\]\((?P<link_url>[^)\n]+)\)
+    | `(?P<code>[^`\n]+)`
+    """, re.VERBOSE)
+
+_span_start = frozenset(
+    string.ascii_letters + string.digits + "., :" + "*[`")
+
+def scan_span_text(text, pos=0):
+    """Match _span_text against `text` from `pos` to the end of the line,
+    returning the nodes it matched and where they end, or None."""
+    nodes = []
+    end = len(text)
+    while pos < end and text[pos] != "\n":
+        token = _inline_token.match(text, pos)
+        if token is None:
+            return None
+        kind = token.lastgroup
+        if kind == 'link_url':
+            nodes.append([
+                'link',
+                ['link_text', token.group('link_text')],
+                ['link_url', token.group('link_url')]])
+        else:
+            nodes.append([kind, token.group(kind)])
+        pos = token.end()
+    if not nodes:
+        return None
+    return nodes, pos
+
+def _span_scanner(name, prefix=None):
+    def scan(text):
+        pos = 0
+        if prefix is not None:
+            found = prefix.match(text)
+            if found is None:
+                raise pg.NoPatternFound()
+            pos = found.end()
+        if pos == len(text) or text[pos] not in _span_start:
+            raise pg.NoPatternFound()
+        scanned = scan_span_text(text, pos)
+        if scanned is None:
+            return None
+        nodes, end = scanned
+        return [name] + nodes, text[end:]
+    return scan
+
+def _first_set(pattern, resolving):
+    # Returns the characters a match of `pattern` can start with (None when
+    # that can't be worked out, meaning any character) and whether it can
+    # match without consuming anything.  Anything unrecognised gets the
+    # safe answer of (None, True).
+    if isinstance(pattern, basestring):
+        if not pattern:
+            return None, True
+        return frozenset(pattern[0]), False
+    if isinstance(pattern, types.FunctionType):
+        if pattern in resolving:
+            return None, True
+        resolving.add(pattern)
+        try:
+            return _first_set(pattern(), resolving)
+        finally:
+            resolving.discard(pattern)
+    if isinstance(pattern, pg.Words):
+        letters = getattr(pattern, 'letters', None)
+        if not letters:
+            return None, True
+        return frozenset(letters), False
+    if isinstance(pattern, pg.Indented):
+        # An indented match starts with its indentation, or blank lines
+        # before it, unless the indentation is optional or given by a
+        # pattern of its own.
+        chars = set(" \t\n")
+        leading = getattr(pattern, 'initial_indent', None)
+        if leading is None and getattr(pattern, 'optional', True):
+            leading = getattr(pattern, 'pattern', None)
+            if leading is None:
+                return None, True
+        if leading is not None:
+            first, _ = _first_set(leading, resolving)
+            if first is None:
+                return None, True
+            chars.update(first)
+        return frozenset(chars), False
+    patterns = getattr(pattern, 'patterns', None)
+    if patterns is None or isinstance(pattern, pg.Not):
+        return None, True
+    chars = set()
+    if isinstance(pattern, pg.AllOf):
+        for part in patterns:
+            first, nullable = _first_set(part, resolving)
+            if first is None:
+                return None, True
+            chars.update(first)
+            if not nullable:
+                return frozenset(chars), False
+        return frozenset(chars), True
+    # Everything else either picks one of its patterns or wraps them, so
+    # it can start with whatever any of them can.
+    nullable = isinstance(pattern, pg.Optional)
+    for part in patterns:
+        first, part_nullable = _first_set(part, resolving)
+        if first is None:
+            return None, True
+        chars.update(first)
+        nullable = nullable or part_nullable
+    return frozenset(chars), nullable
+
+def first_set(pattern):
+    """Return the set of characters a match of `pattern` can start with, or
+    None if it could start with anything (or match nothing at all)."""
+    first, nullable = _first_set(pattern, set())
+    if nullable:
+        return None
+    return first
+
+def dispatch_table(alternatives):
+    """Map each character to the alternatives that could match starting
+    with it, keeping their order.  Characters that aren't in the table can
+    only be matched by the alternatives in the second value returned."""
+    first_sets = [(alternative, first_set(alternative))
+                  for alternative in alternatives]
+    chars = set()
+    for _, first in first_sets:
+        if first is not None:
+            chars.update(first)
+    table = {}
+    for char in chars:
+        table[char] = tuple(
+            alternative for alternative, first in first_sets
+            if first is None or char in first)
+    default = tuple(
+        alternative for alternative, first in first_sets if first is None)
+    return table, default
+
+_body_dispatch = []
+_body_dispatch_lock = thread.allocate_lock()
+
+def _body_dispatch_table():
+    if not _body_dispatch:
+        with _body_dispatch_lock:
+            if not _body_dispatch:
+                _body_dispatch.append(dispatch_table(blocks))
+    return _body_dispatch[0]
+
+_list_item = _Regex(r"(\d+\.|[*+-])[ \t]")
+_newlines = _Regex(r"\n+")
+
+def _code_content(line):
+    # What is left of an indented `line` once its indentation is taken off,
+    # or None if it isn't indented, is only indentation or could start a
+    # list, which needs the full grammar.
+    content = line.lstrip(" \t")
+    if (not content or len(content) == len(line)
+            or _list_item.match(content)):
+        return None
+    return content
+
+def _scan_code_line(text, pos=0):
+    # Matches a code_block at `pos` the way pegger would, a line at a time,
+    # returning the node and the end of the line.  Returns None for lines
+    # that _code_content() turns down.
+    end = text.find("\n", pos)
+    if end < 0:
+        end = len(text)
+    content = _code_content(text[pos:end])
+    if content is None:
+        return None
+    return ['code_block', ['code_line', escape(content)]], end
+
+def _scan_code_block(text):
+    scanned = _scan_code_line(text)
+    if scanned is None:
+        return None
+    node, end = scanned
+    return node, text[end:]
+
+def _scan_body(text):
+    # Matches body the way pg.Many would, but only tries the blocks that
+    # could start with the next character.  Blank lines and code lines are
+    # matched in place, so that long runs of them cost no more than a pass
+    # over the text.
+    table, default = _body_dispatch_table()
+    nodes = []
+    pos = 0
+    matched = False
+    while pos < len(text):
+        if text[pos] == "\n":
+            # What _linebreaks, the first of the blocks, would match.
+            pos = _newlines.match(text, pos).end()
+            matched = True
+            continue
+        if text[pos] in " \t":
+            scanned = _scan_code_line(text, pos)
+            if scanned is not None:
+                node, pos = scanned
+                nodes.append(node)
+                matched = True
+                continue
+        rest = text[pos:]
+        for alternative in table.get(rest[0], default):
+            try:
+                match, remaining = pg.do_parse(rest, alternative)
+            except pg.NoPatternFound:
+                continue
+            break
+        else:
+            break
+        if len(remaining) >= len(rest):
+            return None
+        if (isinstance(alternative, types.FunctionType)
+                and not alternative.__name__.startswith("_")):
+            nodes.append(match)
+        elif match is not None:
+            # Anything else that matched more than an Ignore would have to
+            # be added the way pegger does it.
+            return None
+        matched = True
+        pos = len(text) - len(remaining)
+    if not matched:
+        raise pg.NoPatternFound()
+    return ['body'] + nodes, text[pos:]
+
+scanners = {
+    body: _scan_body,
+    code_block: _scan_code_block,
+    paragraph: _span_scanner('paragraph'),
+    bullet_without_paragraph: _span_scanner(
+        'bullet_without_paragraph', _Regex(r"[*+-][ \t]")),
+    numbered_bullet_without_paragraph: _span_scanner(
+        'numbered_bullet_without_paragraph', _Regex(r"[0-9]+\.[ \t]")),
+    }
+
+class Node(object):
+    """A compact parse tree node.
+
+    `kind` is the name of the rule that matched.  A node that only matched
+    some text, like ['plain', "..."] in list form, keeps that as its `text`
+    and has no `children`; any other node has a tuple of child nodes and
+    strings.
+    """
+
+    __slots__ = ('kind', 'children', 'text')
+
+    def __init__(self, kind, children=(), text=None):
+        self.kind = kind
+        self.children = children
+        self.text = text
+
+    def __repr__(self):
+        if self.text is not None:
+            return "Node(%r, text=%r)" % (self.kind, self.text)
+        return "Node(%r, %r)" % (self.kind, self.children)
+
+    def to_list(self):
+        result = [self.kind]
+        stack = [(self, result)]
+        while stack:
+            node, items = stack.pop()
+            if node.text is not None:
+                items.append(node.text)
+                continue
+            for child in node.children:
+                if isinstance(child, Node):
+                    item = [child.kind]
+                    stack.append((child, item))
+                    child = item
+                items.append(child)
+        return result
+
+    @classmethod
+    def from_list(cls, data):
+        # Each node is made once all of its children have been, so only the
+        # lists on the way down to the one being converted are held open.
+        stack = [(data, iter(data[1:]), [])]
+        while True:
+            item, rest, children = stack[-1]
+            for child in rest:
+                if isinstance(child, basestring):
+                    children.append(child)
+                else:
+                    stack.append((child, iter(child[1:]), []))
+                    break
+            else:
+                stack.pop()
+                if len(item) == 2 and isinstance(item[1], basestring):
+                    node = cls(item[0], text=item[1])
+                else:
+                    node = cls(item[0], tuple(children))
+                if not stack:
+                    return node
+                stack[-1][2].append(node)
 
 lookups = {
     '': None,
@@ -302,61 +710,135 @@ def indent_tags(data):
         result.append("  "+item)
     return result
 
+def _collect(emitter, head, rest):
+    lines = []
+    emitter(head, rest, lines.append)
+    return lines
+
+class Opcode(object):
+    """How to render one kind of node: the routine for its shape of element
+    along with the start and end tags it needs, made ready in advance."""
+
+    __slots__ = ('kind', 'run', 'start_tag', 'end_tag')
+
+    def __init__(self, kind, run, start_tag="", end_tag=""):
+        self.kind = kind
+        self.run = run
+        self.start_tag = start_tag
+        self.end_tag = end_tag
+
+class _Joined(object):
+    # Left on the render stack to emit everything collected in `lines`,
+    # between `prefix` and `suffix`, as a single line.
+
+    __slots__ = ('prefix', 'lines', 'suffix')
+
+    def __init__(self, prefix, lines, suffix):
+        self.prefix = prefix
+        self.lines = lines
+        self.suffix = suffix
+
+def _push(stack, items, emit, indent):
+    for item in reversed(items):
+        stack.append((item, emit, indent))
+
+def _push_inline(stack, items, emit, prefix, suffix):
+    if len(items) == 1 and isinstance(items[0], basestring):
+        emit(prefix + items[0] + suffix)
+        return
+    lines = []
+    stack.append((_Joined(prefix, lines, suffix), emit, ""))
+    _push(stack, items, lines.append, "")
+
+def _run_void_element(op, rest, emit, indent, stack):
+    emit(indent + op.start_tag)
+
+def _run_void_element_with_linebreak(op, rest, emit, indent, stack):
+    _run_void_element(op, rest, emit, indent, stack)
+    emit(indent)
+
+def _run_block(op, rest, emit, indent, stack):
+    emit(indent + op.start_tag)
+    stack.append(("", emit, indent))
+    stack.append((op.end_tag, emit, indent))
+    first = rest[0]
+    if isinstance(first, Node):
+        single_line = first.kind == 'plain'
+    else:
+        single_line = (first[0] == 'plain') or isinstance(first, basestring)
+    if single_line:
+        _push_inline(stack, rest, emit, indent + "  ", "")
+    else:
+        _push(stack, rest, emit, indent + "  ")
+
+def _run_span(op, rest, emit, indent, stack):
+    if len(rest) == 1 and isinstance(rest[0], basestring):
+        emit(indent + op.start_tag + rest[0] + op.end_tag)
+    else:
+        _push_inline(stack, rest, emit, indent + op.start_tag, op.end_tag)
+
+def _run_span_with_linebreak(op, rest, emit, indent, stack):
+    stack.append(("", emit, indent))
+    _run_span(op, rest, emit, indent, stack)
+
+def _run_tagless(op, rest, emit, indent, stack):
+    _push(stack, rest, emit, indent)
+
+def _run_anchor(op, rest, emit, indent, stack):
+    link_text, link_url = rest
+    if isinstance(link_url, Node):
+        link_url = link_url.text
+    else:
+        link_url = link_url[1]
+    start_tag = '''%s<a href="%s">''' % (indent, link_url)
+    _push_inline(stack, [link_text], emit, start_tag, "</a>")
+
+def _run(op, rest, emit, indent):
+    stack = []
+    op.run(op, rest, emit, indent, stack)
+    _render(stack)
+
+def emit_void_element(head, rest, emit, indent=""):
+    _run(_opcode(head, make_void_element), rest, emit, indent)
+
 def make_void_element(head, rest):
-    tag = lookups[head]
-    tag = "<%s/>" % tag
-    return [tag]
+    return _collect(emit_void_element, head, rest)
+
+def emit_void_element_with_linebreak(head, rest, emit, indent=""):
+    _run(_opcode(head, make_void_element_with_linebreak), rest, emit, indent)
 
 def make_void_element_with_linebreak(head, rest):
-    return make_void_element(head, rest) + [""]
+    return _collect(emit_void_element_with_linebreak, head, rest)
+
+def emit_block(head, rest, emit, indent=""):
+    _run(_opcode(head, make_block), rest, emit, indent)
 
 def make_block(head, rest):
-    tag = lookups[head]
-    start_tag = "<%s>" % tag
-    end_tag = "</%s>" % tag
-    content = []
-    if (rest[0][0] == 'plain') or (isinstance(rest[0], basestring)):
-        single_line = True
-    else:
-        single_line = False
-    content = []
-    for item in rest:
-        content.extend(do_render(item))
-    if single_line:
-        content = ["".join(content)]
-    content = indent_tags(content)
-    return [start_tag] + content + [end_tag] + [""]
+    return _collect(emit_block, head, rest)
+
+def emit_span(head, rest, emit, indent=""):
+    _run(_opcode(head, make_span), rest, emit, indent)
 
 def make_span(head, rest):
-    tag = lookups[head]
-    if tag:
-        start_tag = "<%s>" % tag
-        end_tag = "</%s>" % tag
-    else:
-        start_tag = ""
-        end_tag = ""
-    content = []
-    for item in rest:
-        content.extend(do_render(item))
-    content = "".join(content)
-    return ["%s%s%s" % (start_tag, content, end_tag)]
+    return _collect(emit_span, head, rest)
+
+def emit_span_with_linebreak(head, rest, emit, indent=""):
+    _run(_opcode(head, make_span_with_linebreak), rest, emit, indent)
 
 def make_span_with_linebreak(head, rest):
-    return make_span(head, rest) + [""]
+    return _collect(emit_span_with_linebreak, head, rest)
+
+def emit_tagless(head, rest, emit, indent=""):
+    emit_nodes(rest, emit, indent)
 
 def make_tagless(head, rest):
-    content = []
-    for item in rest:
-        content.extend(do_render(item))
-    return content
+    return _collect(emit_tagless, head, rest)
+
+def emit_anchor(head, rest, emit, indent=""):
+    _run(_opcode(head, make_anchor), rest, emit, indent)
 
 def make_anchor(head, rest):
-    link_text, link_url = rest
-    link_text = do_render(link_text)
-    link_url = link_url[1]
-    link_template = '''<a href="%s">%s</a>'''
-    result = link_template % (link_url, "".join(link_text))
-    return [result]
+    return _collect(emit_anchor, head, rest)
 
 tag_funcs = {
     'list_item': make_span,
@@ -384,23 +866,1705 @@ tag_funcs = {
     'blockquote': make_block,
     }
 
+# The tag_funcs above each return a list of lines.  While rendering, the
+# routine each of them is built on is run instead: it hands every line to
+# `emit` as soon as it is ready, already carrying the indentation for its
+# depth, so nested output is never copied or re-indented on the way up.
+# Rather than rendering the nodes inside it by calling back into the
+# renderer, a routine pushes them onto the render stack, so that however
+# deep a tree is, rendering it never recurses.
+runners = {
+    make_void_element: _run_void_element,
+    make_void_element_with_linebreak: _run_void_element_with_linebreak,
+    make_block: _run_block,
+    make_span: _run_span,
+    make_span_with_linebreak: _run_span_with_linebreak,
+    make_tagless: _run_tagless,
+    make_anchor: _run_anchor,
+    }
+
+_void_elements = (make_void_element, make_void_element_with_linebreak)
+
+def _run_lines(func, op, rest, emit, indent, stack):
+    for line in func(op.kind, rest):
+        emit(indent + line)
+
+def _opcode(kind, func=None, tags=None):
+    if func is None:
+        func = tag_funcs[kind]
+    if tags is None:
+        tags = lookups
+    run = runners.get(func)
+    if run is None:
+        return Opcode(kind, functools.partial(_run_lines, func))
+    tag = tags.get(kind)
+    if not tag:
+        return Opcode(kind, run)
+    if func in _void_elements:
+        return Opcode(kind, run, "<%s/>" % tag, "")
+    return Opcode(kind, run, "<%s>" % tag, "</%s>" % tag)
+
+def _make_ops(funcs=None, tags=None):
+    if funcs is None:
+        funcs = tag_funcs
+    if tags is None:
+        tags = lookups
+    return dict(
+        (kind, _opcode(kind, func, tags)) for kind, func in funcs.items())
+
+def _bind(ops):
+    return dict(
+        (kind, functools.partial(op.run, op)) for kind, op in ops.items())
+
+def _make_opcodes(funcs=None, tags=None):
+    return _bind(_make_ops(funcs, tags))
+
+# Maps each kind of node to the routine that renders it, with its Opcode
+# already bound in, so rendering a node takes a single lookup.  It is built
+# the first time anything is rendered, and again whenever tag_funcs or
+# lookups have changed since.
+opcodes = {}
+_opcodes_source = None
+
+def build_opcodes():
+    """Rebuild the opcodes from tag_funcs and lookups."""
+    global opcodes, _opcodes_source
+    source = (dict(tag_funcs), dict(lookups))
+    opcodes = _make_opcodes(*source)
+    _opcodes_source = source
+
+def _module_opcodes():
+    # Comparing the tables is much cheaper than rendering with them, and
+    # catches them being changed in place as well as replaced.
+    if _opcodes_source != (tag_funcs, lookups):
+        build_opcodes()
+    return opcodes
+
+def _render(stack, opcodes=None):
+    if opcodes is None:
+        opcodes = _module_opcodes()
+    pop = stack.pop
+    while stack:
+        data, emit, indent = pop()
+        if isinstance(data, list):
+            head, rest = data[0], data[1:]
+        elif isinstance(data, basestring):
+            emit(indent + data)
+            continue
+        elif isinstance(data, Node):
+            head = data.kind
+            if data.text is None:
+                rest = data.children
+            else:
+                rest = (data.text,)
+        elif isinstance(data, _Joined):
+            emit(data.prefix + "".join(data.lines) + data.suffix)
+            continue
+        else:
+            head, rest = data[0], data[1:]
+        try:
+            run = opcodes[head]
+        except KeyError:
+            # Left out of the table, which may be a Renderer's own shared
+            # between threads.
+            op = _opcode(head)
+            run = functools.partial(op.run, op)
+        run(rest, emit, indent, stack)
+
+def emit_node(data, emit, indent=""):
+    _render([(data, emit, indent)])
+
+def emit_nodes(items, emit, indent=""):
+    stack = []
+    _push(stack, items, emit, indent)
+    _render(stack)
+
+def render_inline(items):
+    if len(items) == 1 and isinstance(items[0], basestring):
+        return items[0]
+    lines = []
+    emit_nodes(items, lines.append)
+    return "".join(lines)
+
 def do_render(data):
-    if isinstance(data, basestring):
-        return [data]
-    else:
-        head, rest = data[0], data[1:]
-        func = tag_funcs[head]
-        return func(head, rest)
+    lines = []
+    emit_node(data, lines.append)
+    return lines
 
 def htmlise(node, depth=0):
     return "\n".join(do_render(node))
 
-def parse(text, pattern=body):
-    if not text.endswith("\n\n"):
-        text = text + "\n\n"
-    return pg.parse_string(text, pattern)
+class StrippedWriter(object):
+    """Writes the lines it is called with to `write`, separated by newlines
+    and without leading or trailing whitespace, just as to_html() would
+    strip the joined lines."""
+
+    def __init__(self, write):
+        self.write = write
+        self.separator = ""
+        self.pending = None
+
+    def __call__(self, line):
+        fragment = self.separator + line
+        self.separator = "\n"
+        if self.pending is None:
+            fragment = fragment.lstrip()
+            if not fragment:
+                return
+            self.pending = ""
+        content = fragment.rstrip()
+        if content:
+            self.write(self.pending + content)
+            self.pending = fragment[len(content):]
+        else:
+            self.pending += fragment
+
+def render_to(tree_or_text, out, pattern=body, packrat=False, fused=False,
+              profile=None, max_steps=None, deadline=None):
+    """Write the HTML for a parse tree, or for markdown text, to the file-like
+    object `out`, producing the same output as to_html().
+
+    With `fused`, markdown text is parsed and written a top level block at a
+    time, so only one block's tree is ever held in memory.
+    """
+    writer = StrippedWriter(out.write)
+    is_text = isinstance(tree_or_text, basestring) or _is_buffer(tree_or_text)
+    if fused and pattern is body and is_text:
+        for node in iter_blocks(tree_or_text, packrat=packrat, profile=profile,
+                                max_steps=max_steps, deadline=deadline):
+            emit_node(node, writer)
+        return
+    if is_text:
+        tree_or_text = parse(tree_or_text, pattern, packrat=packrat,
+                             profile=profile, max_steps=max_steps,
+                             deadline=deadline)
+    emit_node(tree_or_text, writer)
+
+class Backend(object):
+    """Turns a parse tree into some other form, as walk() feeds it events.
+
+    enter() is called with the kind and children of each node before
+    anything inside it, text() with each string and leave() with the kind
+    of each node after everything inside it.  result() returns the output
+    once the walk is over.
+    """
+
+    def enter(self, kind, children):
+        pass
+
+    def text(self, text):
+        pass
+
+    def leave(self, kind):
+        pass
+
+    def result(self):
+        raise NotImplementedError
+
+_leave = object()
+
+def walk(tree, *backends):
+    """Walk a parse tree once, feeding every one of `backends`, and return
+    a list of their results."""
+    enters = [backend.enter for backend in backends]
+    texts = [backend.text for backend in backends]
+    leaves = [backend.leave for backend in backends]
+    stack = [tree]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        item = pop()
+        if item is _leave:
+            kind = pop()
+            for leave in leaves:
+                leave(kind)
+            continue
+        if isinstance(item, basestring):
+            for text in texts:
+                text(item)
+            continue
+        if isinstance(item, Node):
+            kind = item.kind
+            if item.text is None:
+                children = item.children
+            else:
+                children = (item.text,)
+        else:
+            kind, children = item[0], item[1:]
+        for enter in enters:
+            enter(kind, children)
+        push(kind)
+        push(_leave)
+        for child in reversed(children):
+            push(child)
+    return [backend.result() for backend in backends]
+
+class HTMLBackend(Backend):
+    """Renders the same HTML as htmlise(), using the opcodes made from
+    `tag_funcs` and `lookups` (by default the module's own)."""
+
+    def __init__(self, tag_funcs=None, lookups=None):
+        self.ops = _make_ops(tag_funcs, lookups)
+        self.opcodes = _bind(self.ops)
+        self.lines = []
+        # Each open node has the `emit` and indent for what is inside it,
+        # and what to do once it is closed.
+        self.frames = [(self.lines.append, "", None)]
+        self.skipping = 0
+
+    def enter(self, kind, children):
+        if self.skipping:
+            self.skipping += 1
+            return
+        emit, indent, _ = self.frames[-1]
+        op = self.ops[kind]
+        run = op.run
+        if run is _run_tagless:
+            self.frames.append((emit, indent, None))
+        elif run is _run_span or run is _run_span_with_linebreak:
+            lines = []
+            def close():
+                emit(indent + op.start_tag + "".join(lines) + op.end_tag)
+                if run is _run_span_with_linebreak:
+                    emit(indent)
+            self.frames.append((lines.append, "", close))
+        elif run is _run_block:
+            emit(indent + op.start_tag)
+            first = children[0]
+            if isinstance(first, Node):
+                single_line = first.kind == 'plain'
+            else:
+                single_line = (
+                    (first[0] == 'plain') or isinstance(first, basestring))
+            if single_line:
+                lines = []
+                def close():
+                    emit(indent + "  " + "".join(lines))
+                    emit(indent + op.end_tag)
+                    emit(indent)
+                self.frames.append((lines.append, "", close))
+            else:
+                def close():
+                    emit(indent + op.end_tag)
+                    emit(indent)
+                self.frames.append((emit, indent + "  ", close))
+        else:
+            # Anything else, such as a link, is rendered whole, and what's
+            # inside it is skipped.
+            stack = []
+            run(op, children, emit, indent, stack)
+            _render(stack, self.opcodes)
+            self.skipping = 1
+
+    def text(self, text):
+        if not self.skipping:
+            emit, indent, _ = self.frames[-1]
+            emit(indent + text)
+
+    def leave(self, kind):
+        if self.skipping:
+            self.skipping -= 1
+            return
+        close = self.frames.pop()[2]
+        if close is not None:
+            close()
+
+    def result(self):
+        return "\n".join(self.lines)
+
+def unescape(text):
+    return text.replace("&lt;", "<").replace("&gt;", ">").replace("&amp;", "&")
+
+class TextBackend(Backend):
+    """Extracts the text of a document, for indexing, with each block on a
+    line of its own and without link urls or markup."""
+
+    line_kinds = frozenset([
+        'paragraph', 'title_level_1', 'title_level_2', 'code_line',
+        'blockquote', 'horizontal_rule', 'list_item',
+        'bullet_with_paragraph', 'bullet_without_paragraph',
+        'numbered_bullet_with_paragraph', 'numbered_bullet_without_paragraph',
+        ])
+    # Kinds whose text is still escaped for HTML, and kinds to leave out
+    escaped_kinds = frozenset(['code_line'])
+    skipped_kinds = frozenset(['link_url'])
+
+    def __init__(self):
+        self.parts = []
+        self.escaped = 0
+        self.skipping = 0
+
+    def enter(self, kind, children):
+        if self.skipping or kind in self.skipped_kinds:
+            self.skipping += 1
+        elif kind in self.escaped_kinds:
+            self.escaped += 1
+
+    def text(self, text):
+        if self.skipping:
+            return
+        if self.escaped:
+            text = unescape(text)
+        self.parts.append(text)
+
+    def leave(self, kind):
+        if self.skipping:
+            self.skipping -= 1
+            return
+        if kind in self.escaped_kinds:
+            self.escaped -= 1
+        if kind in self.line_kinds:
+            self.parts.append("\n")
+
+    def result(self):
+        lines = "".join(self.parts).split("\n")
+        return "\n".join(line.strip() for line in lines if line.strip())
+
+class JSONBackend(Backend):
+    """Produces the tree as JSON, with each node as an object with its
+    "type" and a list of its "children", which are nodes and strings."""
+
+    def __init__(self, **dump_options):
+        self.dump_options = dump_options
+        self.root = []
+        self.stack = [self.root]
+
+    def enter(self, kind, children):
+        node = collections.OrderedDict(
+            [('type', kind), ('children', [])])
+        self.stack[-1].append(node)
+        self.stack.append(node['children'])
+
+    def text(self, text):
+        self.stack[-1].append(text)
+
+    def leave(self, kind):
+        self.stack.pop()
+
+    def result(self):
+        import json
+        return json.dumps(self.root[0], **self.dump_options)
+
+def to_text(text, pattern=body):
+    return walk(parse(text, pattern), TextBackend())[0]
 
-def to_html(text, pattern=body):
+def to_json(text, pattern=body):
+    return walk(parse(text, pattern), JSONBackend())[0]
+
+def compile_grammar(pattern=body):
+    """Resolve every rule up front so the first parse doesn't pay for it."""
+    for compiled_rule in rules:
+        compiled_rule()
+    _body_dispatch_table()
+    return pattern
+
+def _code_signature(code):
+    # Everything about a function's code that affects what it does, leaving
+    # out line numbers so that moving it around doesn't change the result.
+    consts = tuple(
+        _code_signature(const) if isinstance(const, types.CodeType)
+        else repr(const)
+        for const in code.co_consts)
+    return repr((code.co_code, code.co_names, code.co_varnames, consts))
+
+def _pattern_signature(value, seen):
+    if isinstance(value, (basestring, int, long, float, type(None))):
+        return repr(value)
+    if isinstance(value, types.FunctionType):
+        if hasattr(value, '__wrapped__'):
+            # Rules are signed by grammar_fingerprint() themselves.
+            return value.__name__
+        return value.__name__ + _code_signature(value.__code__)
+    if isinstance(value, (list, tuple)):
+        return "[%s]" % ",".join(
+            _pattern_signature(item, seen) for item in value)
+    if isinstance(value, dict):
+        return "{%s}" % ",".join(
+            "%s:%s" % (_pattern_signature(key, seen),
+                       _pattern_signature(item, seen))
+            for key, item in sorted(value.items()))
+    if id(value) in seen:
+        return "..."
+    seen.add(id(value))
+    attributes = getattr(value, '__dict__', {})
+    return "%s(%s)" % (type(value).__name__, ",".join(
+        "%s=%s" % (name, _pattern_signature(item, seen))
+        for name, item in sorted(attributes.items())))
+
+def _global_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(_global_names(const))
+    return names
+
+def _value_signature(value, seen):
+    if isinstance(value, types.FunctionType):
+        if hasattr(value, '__wrapped__'):
+            return value.__name__
+        return _function_signature(value, seen)
+    if isinstance(value, (_Regex, type(re.compile("")))):
+        return repr((value.pattern, value.flags))
+    if isinstance(value, (basestring, int, long, float, type(None))):
+        return repr(value)
+    if isinstance(value, (tuple, frozenset)):
+        items = [_value_signature(item, seen) for item in value]
+        if isinstance(value, frozenset):
+            items.sort()
+        return "(%s)" % ",".join(items)
+    # Modules, locks and the tables filled in as parsing goes are left out
+    return type(value).__name__
+
+def _function_signature(func, seen):
+    # A function's code, along with the functions, regexes and constants it
+    # gets from its defaults, its closure or the globals it names.
+    if func in seen:
+        return func.__name__
+    seen.add(func)
+    values = list(func.__defaults__ or ())
+    values.extend(cell.cell_contents for cell in func.__closure__ or ())
+    values.extend(func.__globals__[name]
+                  for name in sorted(_global_names(func.__code__))
+                  if name in func.__globals__)
+    return func.__name__ + _code_signature(func.__code__) + "".join(
+        _value_signature(value, seen) for value in values)
+
+def _pegger_signature():
+    # pegger doesn't always have a __version__, so its code is signed too.
+    _load_pegger()
+    parts = [getattr(pg, '__version__', '')]
+    for name, value in sorted(vars(pg).items()):
+        if value is _do_parse:
+            value = _pegger_do_parse
+        if getattr(value, '__module__', None) != pg.__name__:
+            continue
+        if isinstance(value, types.FunctionType):
+            parts.append(name + _code_signature(value.__code__))
+        elif isinstance(value, (type, types.ClassType)):
+            parts.append(name + repr([base.__name__
+                                      for base in value.__bases__]))
+            for attribute, item in sorted(vars(value).items()):
+                if isinstance(item, types.FunctionType):
+                    parts.append(attribute + _code_signature(item.__code__))
+    return "".join(parts)
+
+def grammar_fingerprint():
+    """Return a hash of the grammar: the code and pattern of every rule, the
+    scanners, the lookups table and the versions of markdown3 and pegger.
+    It changes whenever the grammar does, and so can be used to tell stale
+    parse trees apart."""
+    import hashlib
+    digest = hashlib.sha1(__version__)
+    digest.update(_pegger_signature())
+    for compiled_rule in rules:
+        digest.update(compiled_rule.__name__)
+        digest.update(_code_signature(compiled_rule.__wrapped__.__code__))
+        digest.update(_pattern_signature(compiled_rule(), set()))
+    seen = set()
+    for pattern, scanner in sorted(scanners.items(),
+                                   key=lambda item: item[0].__name__):
+        digest.update(pattern.__name__)
+        digest.update(_function_signature(scanner, seen))
+    digest.update(repr(sorted(lookups.items())))
+    return digest.hexdigest()
+
+def _tables_digest(funcs=None, tags=None):
+    # A hash of the tag_funcs and lookups a Renderer renders with, for
+    # keying the HTML it puts in a RenderCache.
+    import hashlib
+    if funcs is None:
+        funcs = tag_funcs
+    if tags is None:
+        tags = lookups
+    digest = hashlib.sha1()
+    seen = set()
+    for kind, func in sorted(funcs.items()):
+        digest.update(kind)
+        if isinstance(func, types.FunctionType):
+            digest.update(_function_signature(func, seen))
+        else:
+            digest.update(repr(func))
+    digest.update(repr(sorted(tags.items())))
+    return digest.hexdigest()
+
+class PackratCache(object):
+    """Memoised rule matches for a single document.
+
+    Entries are keyed on the rule and where it was tried, and the least
+    recently used ones are evicted once there are more than `max_entries`.
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        result = self._entries.pop(key)
+        self._entries[key] = result
+        return result
+
+    def put(self, key, result):
+        self._entries[key] = result
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+class RuleStats(object):
+    __slots__ = ('calls', 'successes', 'failures', 'seconds', 'own_seconds')
+
+    def __init__(self):
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        self.seconds = 0.0
+        self.own_seconds = 0.0
+
+class Profile(object):
+    """Call counts and timings for each rule, gathered while parsing.
+
+    `seconds` includes the time spent in the rules a rule tried in turn,
+    while `own_seconds` doesn't.  A failure means pegger had to backtrack
+    and try something else.
+    """
+
+    def __init__(self):
+        self.stats = collections.defaultdict(RuleStats)
+        self._nested = []
+        self._active = collections.defaultdict(int)
+
+    def call(self, name, func, *args):
+        self._nested.append(0.0)
+        self._active[name] += 1
+        start = timeit.default_timer()
+        try:
+            result = func(*args)
+        except Exception:
+            self._record(name, start, False)
+            raise
+        self._record(name, start, True)
+        return result
+
+    def _record(self, name, start, success):
+        elapsed = timeit.default_timer() - start
+        nested = self._nested.pop()
+        if self._nested:
+            self._nested[-1] += elapsed
+        stats = self.stats[name]
+        stats.calls += 1
+        if success:
+            stats.successes += 1
+        else:
+            stats.failures += 1
+        self._active[name] -= 1
+        if not self._active[name]:
+            # Only the outermost of a set of recursive calls counts, or
+            # the time spent in the inner ones would be added twice.
+            stats.seconds += elapsed
+        stats.own_seconds += elapsed - nested
+
+    def report(self, sort='seconds', limit=None):
+        rows = sorted(
+            self.stats.items(),
+            key=lambda item: getattr(item[1], sort),
+            reverse=True)
+        lines = ["%-45s %8s %9s %9s %10s %10s" % (
+            "rule", "calls", "successes", "failures", "seconds", "own")]
+        for name, stats in rows[:limit]:
+            lines.append("%-45s %8d %9d %9d %10.4f %10.4f" % (
+                name, stats.calls, stats.successes, stats.failures,
+                stats.seconds, stats.own_seconds))
+        return "\n".join(lines)
+
+class ParseLimitExceeded(Exception):
+    pass
+
+class ParseBudget(object):
+    """Limits a parse to `max_steps` calls into the grammar, and to
+    `deadline` seconds from when the budget was made."""
+
+    def __init__(self, max_steps=None, deadline=None):
+        self.max_steps = max_steps
+        self.steps = 0
+        if deadline is None:
+            self.expires = None
+        else:
+            self.expires = timeit.default_timer() + deadline
+
+    def step(self):
+        self.steps += 1
+        if self.max_steps is not None and self.steps > self.max_steps:
+            raise ParseLimitExceeded(
+                "Gave up after %s steps" % self.max_steps)
+        # Reading the clock costs more than a step, so only look now and then
+        if (self.expires is not None and not self.steps % 256
+                and timeit.default_timer() > self.expires):
+            raise ParseLimitExceeded("Ran out of time")
+
+class ParseContext(object):
+    """Per-call parsing state, consulted whenever pegger resolves a rule."""
+
+    def __init__(self, packrat=None, profile=None, scanners=scanners,
+                 budget=None):
+        self.packrat = packrat
+        self.profile = profile
+        self.scanners = scanners
+        self.budget = budget
+        # Every string a rule is tried against is the end of either the
+        # document or of the dedented text of an Indented match.  `scope`
+        # says which, so that with its length it says where the rule was
+        # tried without hashing or keeping the text itself.
+        self.scope = None
+        self._indented = []
+
+    def match(self, text, pattern):
+        if self.profile is None:
+            return self._match(text, pattern)
+        return self.profile.call(pattern.__name__, self._match, text, pattern)
+
+    def _match(self, text, pattern):
+        scanner = self.scanners.get(pattern)
+        if scanner is not None:
+            result = scanner(text)
+            if result is not None:
+                return result
+        if self.packrat is None:
+            return _pegger_do_parse(text, pattern)
+        key = (pattern, self.scope, len(text))
+        try:
+            result = self.packrat.get(key)
+        except KeyError:
+            try:
+                # pegger matches a rule's pattern without going back
+                # through do_parse, so an Indented one is caught here.
+                if isinstance(pattern(), pg.Indented):
+                    match, rest = self.match_indented(
+                        text, pattern, pattern())
+                else:
+                    match, rest = _pegger_do_parse(text, pattern)
+            except pg.NoPatternFound as e:
+                result = e
+            else:
+                result = (match, len(rest))
+            self.packrat.put(key, result)
+        if isinstance(result, pg.NoPatternFound):
+            raise result
+        match, remaining = result
+        return match, text[len(text) - remaining:]
+
+    def match_indented(self, text, pattern, indented=None):
+        # The text pegger dedents depends only on where the match starts
+        # and on its initial_indent, so matches with the same ones share
+        # a scope.
+        if indented is None:
+            indented = pattern
+        outer = self.scope
+        self._indented.append(
+            (indented.pattern, (outer, len(text), indented.initial_indent)))
+        try:
+            return _pegger_do_parse(text, pattern)
+        finally:
+            self._indented.pop()
+            self.scope = outer
+
+    def match_dedented(self, text, pattern):
+        outer = self.scope
+        frame = self._indented.pop()
+        self.scope = frame[1]
+        try:
+            if isinstance(pattern, types.FunctionType):
+                return self.match(text, pattern)
+            return _pegger_do_parse(text, pattern)
+        finally:
+            self.scope = outer
+            self._indented.append(frame)
+
+_local = thread._local()
+_hook_lock = thread.allocate_lock()
+_hook_users = 0
+
+def _do_parse(text, pattern):
+    context = getattr(_local, 'context', None)
+    if context is None:
+        return _pegger_do_parse(text, pattern)
+    if context.budget is not None:
+        context.budget.step()
+    if context.packrat is not None:
+        if isinstance(pattern, pg.Indented):
+            return context.match_indented(text, pattern)
+        if context._indented and pattern is context._indented[-1][0]:
+            return context.match_dedented(text, pattern)
+    if not isinstance(pattern, types.FunctionType):
+        return _pegger_do_parse(text, pattern)
+    return context.match(text, pattern)
+
+@contextlib.contextmanager
+def _hooked():
+    # pegger's do_parse is only replaced while a parse is running, and
+    # passes straight through for any thread that isn't parsing.
+    global _hook_users
+    _load_pegger()
+    with _hook_lock:
+        if not _hook_users:
+            pg.do_parse = _do_parse
+        _hook_users += 1
+    try:
+        yield
+    finally:
+        with _hook_lock:
+            _hook_users -= 1
+            if not _hook_users:
+                pg.do_parse = _pegger_do_parse
+
+@contextlib.contextmanager
+def profiling(profile=None):
+    """Record every parse made by this thread inside the with block in
+    `profile`, or in a new Profile that the block is given."""
+    if profile is None:
+        profile = Profile()
+    previous = getattr(_local, 'profile', None)
+    _local.profile = profile
+    try:
+        yield profile
+    finally:
+        _local.profile = previous
+
+@contextlib.contextmanager
+def _profiled():
+    # What profile=True gives a single call: a Profile of its own, whose
+    # report is logged once the call is over.
+    profile = Profile()
+    try:
+        yield profile
+    finally:
+        import logging
+        logging.getLogger(__name__).info(
+            "Profile of a parse:\n%s", profile.report())
+
+def _make_context(packrat=False, profile=None, budget=None):
+    if profile is not None and not isinstance(profile, Profile):
+        raise TypeError(
+            "profile should be a Profile, True or None, not %r" % (profile,))
+    if packrat is True:
+        packrat = PackratCache()
+    elif packrat is False:
+        packrat = None
+    if profile is None:
+        profile = getattr(_local, 'profile', None)
+    return ParseContext(packrat=packrat, profile=profile, budget=budget)
+
+def _make_budget(max_steps, deadline):
+    if max_steps is None and deadline is None:
+        return None
+    return ParseBudget(max_steps, deadline)
+
+def _parse_string(text, pattern, context):
+    previous = getattr(_local, 'context', None)
+    _local.context = context
+    try:
+        with _hooked():
+            return pg.parse_string(text, pattern)
+    finally:
+        _local.context = previous
+
+def _parse_text(text, pattern, context):
     if not text.endswith("\n\n"):
         text = text + "\n\n"
-    return htmlise(pg.parse_string(text, pattern)).strip()
+    return _parse_string(text, pattern, context)
+
+def parse(text, pattern=body, packrat=False, typed=False, profile=None,
+          max_steps=None, deadline=None, cache=None):
+    if profile is True:
+        with _profiled() as profile:
+            return parse(text, pattern, packrat, typed, profile, max_steps,
+                         deadline, cache)
+    if _is_buffer(text) and (pattern is not body or cache is not None):
+        raise ValueError(
+            "A buffer can only be parsed as a body, without a cache")
+    if _is_buffer(text) or (typed and pattern is body and cache is None):
+        # A block at a time, so that a typed tree is built without ever
+        # holding the list form of the whole document as well.
+        blocks = iter_blocks(text, packrat=packrat, typed=typed,
+                             profile=profile, max_steps=max_steps,
+                             deadline=deadline)
+        if typed:
+            return Node('body', tuple(blocks))
+        return ['body'] + list(blocks)
+    tree = None
+    if cache is not None:
+        tree = cache.get(text, pattern)
+    if tree is None:
+        context = _make_context(packrat, profile,
+                                _make_budget(max_steps, deadline))
+        tree = _parse_text(text, pattern, context)
+        if cache is not None:
+            cache.put(text, pattern, tree)
+    if typed:
+        return Node.from_list(tree)
+    return tree
+
+def escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def _escaped_paragraph(text):
+    return ['paragraph', ['plain', escape(text.strip())]]
+
+def _parse_or_escape(chunk, packrat, profile, max_steps, expires):
+    # Each block gets `max_steps` of its own, but they all share the time
+    deadline = None
+    if expires is not None:
+        deadline = expires - timeit.default_timer()
+        if deadline <= 0:
+            return [_escaped_paragraph(chunk)]
+    try:
+        return parse(chunk, packrat=packrat, profile=profile,
+                     max_steps=max_steps, deadline=deadline)[1:]
+    except ParseLimitExceeded:
+        return [_escaped_paragraph(chunk)]
+
+def to_html(text, pattern=body, packrat=False, profile=None,
+            max_steps=None, deadline=None, degrade=False, fused=False):
+    """Convert markdown `text` to HTML.
+
+    Parsing stops with ParseLimitExceeded once it has taken `max_steps`
+    steps or `deadline` seconds.  With `degrade`, the body is instead parsed
+    a block at a time, each with `max_steps` of its own, and any block that
+    runs out is shown as a paragraph of its escaped text.
+
+    With `fused`, each top level block is rendered as soon as it has been
+    parsed and its tree thrown away, so that the tree of the whole document
+    is never built.  `text` can also be a buffer (a bytearray, memoryview or
+    mmap) holding a body, which is always converted a block at a time,
+    without ever copying all of it.
+
+    `profile` is a Profile to record the parse in, or True to log the
+    report of one to the "markdown3" logger at the INFO level.
+    """
+    if profile is True:
+        with _profiled() as profile:
+            return to_html(text, pattern, packrat, profile, max_steps,
+                           deadline, degrade, fused)
+    if _is_buffer(text) and pattern is not body:
+        raise ValueError("A buffer can only be converted as a body")
+    if (fused or _is_buffer(text)) and pattern is body and not degrade:
+        return "".join(iter_html(text, packrat=packrat, profile=profile,
+                                 max_steps=max_steps, deadline=deadline))
+    if degrade and pattern is body:
+        expires = ParseBudget(deadline=deadline).expires
+        tree = ['body']
+        def parse_chunk(chunk):
+            return _parse_or_escape(
+                chunk, packrat, profile, max_steps, expires)
+        for _, nodes in _iter_parsed(_iter_chunks(text), parse_chunk):
+            tree.extend(nodes)
+        return htmlise(tree).strip()
+    context = _make_context(packrat, profile,
+                            _make_budget(max_steps, deadline))
+    return htmlise(_parse_text(text, pattern, context)).strip()
+
+def _write_atomically(path, data):
+    import tempfile
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+    # Write to a temporary file first so that readers in other threads or
+    # processes never see a partly written file.
+    fd, temp_path = tempfile.mkstemp(dir=dirname or ".")
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(temp_path, path)
+
+def _cache_key(text, *parts):
+    # What a RenderCache or ParseCache files `text` under: a hash of it
+    # and of everything else that went into converting it.
+    import hashlib
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hashlib.sha1("\0".join(parts + (text,))).hexdigest()
+
+class _DiskStore(object):
+    # Files named by their keys in `directory`, which any number of threads
+    # and processes can share.  Once there are more than `max_entries` of
+    # them, or they add up to more than `max_bytes`, the least recently used
+    # are removed until both are back down to three quarters of that.
+
+    def __init__(self, directory, max_bytes=None, max_entries=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._usage = None
+        self._lock = thread.allocate_lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def read(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Mark the entry as recently used, for prune().
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def write(self, key, data):
+        _write_atomically(self.path(key), data)
+        with self._lock:
+            if self._usage is None:
+                entries = list(self._entries())
+                self._usage = (sum(entry[1] for entry in entries),
+                               len(entries))
+            else:
+                size, count = self._usage
+                self._usage = (size + len(data), count + 1)
+            full = self._over(self._usage, 1)
+        if full:
+            self.prune()
+
+    def _over(self, usage, fraction):
+        size, count = usage
+        return ((self.max_bytes is not None
+                 and size > self.max_bytes * fraction)
+                or (self.max_entries is not None
+                    and count > self.max_entries * fraction))
+
+    def _entries(self):
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                # Skip files that another process is still writing.
+                if len(filename) != 40:
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def prune(self):
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        count = len(entries)
+        for _, entry_size, path in entries:
+            if not self._over((size, count), 0.75):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # Another process got to it first.
+                pass
+            size -= entry_size
+            count -= 1
+        with self._lock:
+            self._usage = (size, count)
+
+class RenderCache(object):
+    """A least recently used cache of rendered HTML that can be shared
+    between threads.
+
+    Entries are keyed on a hash of the markdown, the name of the pattern it
+    was rendered with, the grammar_fingerprint() and `tables`, the hash of
+    the tag_funcs and lookups of the Renderer that rendered it.  They are
+    evicted once there are more than `max_entries` of them or they add up
+    to more than `max_bytes`.  If a `directory` is given, every rendering is also written
+    there, so that it outlives the process and can be found by other caches
+    using the same directory.  Once there are more than `max_disk_entries`
+    files there, or they add up to more than `max_disk_bytes`, the least
+    recently used are removed.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=16 * 1024 * 1024,
+                 directory=None, max_disk_bytes=256 * 1024 * 1024,
+                 max_disk_entries=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.fingerprint = grammar_fingerprint()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = thread.allocate_lock()
+        self._disk = None
+        if directory is not None:
+            self._disk = _DiskStore(directory, max_disk_bytes,
+                                    max_disk_entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, text, pattern=body, tables=""):
+        return _cache_key(text, self.fingerprint, tables, pattern.__name__)
+
+    def get(self, text, pattern=body, tables=""):
+        key = self.key(text, pattern, tables)
+        with self._lock:
+            html = self._entries.pop(key, None)
+            if html is not None:
+                self._entries[key] = html
+                self.hits += 1
+                return html
+        html = self._read(key, isinstance(text, unicode))
+        with self._lock:
+            if html is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._store(key, html)
+        return html
+
+    def put(self, text, pattern, html, tables=""):
+        key = self.key(text, pattern, tables)
+        with self._lock:
+            self._store(key, html)
+        self._write(key, html)
+
+    def _store(self, key, html):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self._entries[key] = html
+        self.size += len(html)
+        while (len(self._entries) > self.max_entries
+               or self.size > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def _read(self, key, decode):
+        if self._disk is None:
+            return None
+        html = self._disk.read(key)
+        if html is not None and decode:
+            html = html.decode('utf-8')
+        return html
+
+    def _write(self, key, html):
+        if self._disk is None:
+            return
+        if isinstance(html, unicode):
+            html = html.encode('utf-8')
+        self._disk.write(key, html)
+
+class ParseCache(object):
+    """Parse trees kept in `directory`, which any number of threads and
+    processes can share.
+
+    Entries are keyed on a hash of the markdown, the name of the pattern it
+    was parsed with and the grammar_fingerprint(), so trees parsed by a
+    different grammar are never returned.  They are stored with marshal,
+    which loads far faster than parsing again.  Once the entries add up to
+    more than `max_bytes`, or there are more than `max_entries` of them, the
+    least recently used are removed until they are back down to three
+    quarters of that.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024,
+                 max_entries=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.fingerprint = grammar_fingerprint()
+        self.hits = 0
+        self.misses = 0
+        self._disk = _DiskStore(directory, max_bytes, max_entries)
+        self._lock = thread.allocate_lock()
+
+    def key(self, text, pattern=body):
+        return _cache_key(text, self.fingerprint, pattern.__name__)
+
+    def get(self, text, pattern=body):
+        data = self._disk.read(self.key(text, pattern))
+        tree = None
+        if data is not None:
+            try:
+                tree = marshal.loads(data)
+            except (EOFError, ValueError, TypeError):
+                pass
+        with self._lock:
+            if tree is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return tree
+
+    def put(self, text, pattern, tree):
+        self._disk.write(self.key(text, pattern), marshal.dumps(tree))
+
+    def prune(self):
+        """Remove the least recently used entries until those left are back
+        down to three quarters of `max_bytes` and `max_entries`."""
+        self._disk.prune()
+
+class Renderer(object):
+    """Converts markdown to HTML, reusing earlier renderings from `cache`
+    (a RenderCache) when it is given one.
+
+    A Renderer can be shared by any number of threads.  The grammar is
+    compiled when it is made, and it renders with its own opcodes, built
+    then from `tag_funcs` and `lookups` (the module's own by default), so
+    nothing it uses changes after that except the cache, which does its own
+    locking.  Everything to do with a single call is kept in a ParseContext
+    made for that call.  Renderers with different tables can share a cache,
+    as its entries are keyed on a hash of the tables too.
+
+    Like the module's functions, parse() and to_html() also take a buffer
+    holding a body, which is converted a block at a time and never cached.
+    """
+
+    def __init__(self, cache=None, tag_funcs=None, lookups=None,
+                 packrat=False, max_steps=None, deadline=None):
+        compile_grammar()
+        self.cache = cache
+        self.packrat = packrat
+        self.max_steps = max_steps
+        self.deadline = deadline
+        self.opcodes = _make_opcodes(tag_funcs, lookups)
+        self.tables = _tables_digest(tag_funcs, lookups)
+
+    def context(self):
+        """Return the state for a single call."""
+        return _make_context(self.packrat, budget=_make_budget(
+            self.max_steps, self.deadline))
+
+    def parse(self, text, pattern=body):
+        if _is_buffer(text):
+            if pattern is not body:
+                raise ValueError("A buffer can only be parsed as a body")
+            return ['body'] + list(iter_blocks(
+                text, packrat=self.packrat, max_steps=self.max_steps,
+                deadline=self.deadline))
+        if not text.endswith("\n\n"):
+            text = text + "\n\n"
+        return _parse_string(text, pattern, self.context())
+
+    def htmlise(self, tree):
+        lines = []
+        _render([(tree, lines.append, "")], self.opcodes)
+        return "\n".join(lines)
+
+    def to_html(self, text, pattern=body):
+        if _is_buffer(text):
+            if pattern is not body:
+                raise ValueError("A buffer can only be converted as a body")
+            return "".join(self.iter_html(text))
+        if self.cache is None:
+            return self.htmlise(self.parse(text, pattern)).strip()
+        html = self.cache.get(text, pattern, self.tables)
+        if html is None:
+            html = self.htmlise(self.parse(text, pattern)).strip()
+            self.cache.put(text, pattern, html, self.tables)
+        return html
+
+    def iter_html(self, source):
+        """Yield the HTML for `source` a top level block at a time, like the
+        module's iter_html(), but rendered with this Renderer's tables and
+        limits.  The cache isn't used."""
+        pieces = []
+        writer = StrippedWriter(pieces.append)
+        for node in iter_blocks(source, packrat=self.packrat,
+                                max_steps=self.max_steps,
+                                deadline=self.deadline):
+            _render([(node, writer, "")], self.opcodes)
+            if pieces:
+                yield "".join(pieces)
+                del pieces[:]
+
+def _to_html_or_error(args):
+    text, pattern = args
+    try:
+        return to_html(text, pattern)
+    except Exception as e:
+        return e
+
+def to_html_many(texts, workers=None, chunksize=None, pattern=body,
+                 min_batch=64):
+    """Convert a batch of independent documents, spread over a pool of
+    `workers` processes.
+
+    Results come back in the same order as `texts`.  A document that fails
+    to convert doesn't stop the batch; the exception it raised is returned
+    in its place.  Batches smaller than `min_batch` are converted in this
+    process, where starting a pool would cost more than it saves.
+    """
+    import multiprocessing
+    jobs = [(text, pattern) for text in texts]
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1 or len(jobs) < min_batch:
+        return [_to_html_or_error(job) for job in jobs]
+    if chunksize is None:
+        chunksize = max(1, len(jobs) // (workers * 4))
+    pool = multiprocessing.Pool(workers, initializer=compile_grammar)
+    try:
+        results = pool.map(_to_html_or_error, jobs, chunksize)
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return results
+
+def _is_buffer(source):
+    # Nothing can be an mmap unless something else has imported mmap.
+    mmap = sys.modules.get('mmap')
+    return (isinstance(source, (bytearray, memoryview))
+            or mmap is not None and isinstance(source, mmap.mmap))
+
+def _iter_buffer(data, size=64 * 1024):
+    for start in range(0, len(data), size):
+        window = data[start:start + size]
+        if isinstance(window, memoryview):
+            window = window.tobytes()
+        yield bytes(window)
+
+def _iter_lines(source):
+    if isinstance(source, basestring):
+        source = [source]
+    elif _is_buffer(source):
+        source = _iter_buffer(source)
+    partial = []
+    for chunk in source:
+        if "\n" not in chunk:
+            partial.append(chunk)
+            continue
+        lines = chunk.split("\n")
+        partial.append(lines[0])
+        lines[0] = "".join(partial)
+        partial = [lines.pop()]
+        for line in lines:
+            yield line + "\n"
+    tail = "".join(partial)
+    if tail:
+        yield tail
+
+def _is_code_line(line):
+    # A line of only whitespace counts as blank here, even where the
+    # grammar would make a code line of it.
+    return bool(line.strip()) and _code_content(line) is not None
+
+def _iter_chunks(source, code_chunk_size=64 * 1024):
+    # A blank line only ends a chunk when the next line can't carry on the
+    # block before it: it isn't indented, and it isn't another item of a
+    # list that the last unindented line belonged to.  A list can start
+    # part way through a line that stops being a paragraph, so any bullet
+    # in that line counts.  Outside of lists every code line is a block of
+    # its own, so long runs of them are split into chunks of about
+    # `code_chunk_size` characters.
+    lines = []
+    size = 0
+    after_blank = False
+    in_list = False
+    after_code = False
+    for line in _iter_lines(source):
+        code = _is_code_line(line)
+        if (code and after_code and not in_list
+                and size >= code_chunk_size):
+            yield "".join(lines)
+            lines = []
+            size = 0
+        after_code = code
+        if not line.strip():
+            after_blank = bool(lines)
+        elif line[0] in " \t":
+            after_blank = False
+            if not code:
+                in_list = True
+        else:
+            if after_blank and not (in_list and _list_item.match(line)):
+                yield "".join(lines)
+                lines = []
+                size = 0
+            after_blank = False
+            in_list = _list_item.search(line) is not None
+        lines.append(line)
+        size += len(line)
+    if lines:
+        yield "".join(lines)
+
+def _iter_parsed(chunks, parse_chunk, max_merged=16):
+    # Yields each chunk along with parse_chunk() of it.  Chunks are split
+    # without looking inside lines, so a link or code span can run over a
+    # blank line into the next chunk; a chunk that won't parse on its own
+    # is parsed again together with the ones after it, and after
+    # `max_merged` of them with the rest of the document.
+    chunks = iter(chunks)
+    following = next(chunks, None)
+    while following is not None:
+        pending = [following]
+        following = next(chunks, None)
+        while True:
+            try:
+                result = parse_chunk("".join(pending))
+            except pg.NoPatternFound:
+                if following is None:
+                    raise
+            else:
+                if len(pending) == 1 or following is None:
+                    break
+                # The blank line that ended the merged chunks was taken for
+                # the end of a block without knowing a span ran over the
+                # one before it, so the block can carry on into the next
+                # chunk, as a list does with another item.  It only ends
+                # there if parsing the next chunk along with it leaves it
+                # as it is.
+                try:
+                    joined = parse_chunk("".join(pending + [following]))
+                except pg.NoPatternFound:
+                    joined = None
+                if joined is not None and joined[:len(result)] == result:
+                    break
+            pending.append(following)
+            following = next(chunks, None)
+            if len(pending) >= max_merged and following is not None:
+                pending.append(following)
+                pending.extend(chunks)
+                following = None
+        yield "".join(pending), result
+
+def iter_blocks(source, packrat=False, typed=False, profile=None,
+                max_steps=None, deadline=None):
+    """Parse `source` (a string, buffer, file or iterable of strings)
+    incrementally, yielding each top level node of the body as soon as it
+    is complete.  `max_steps` and `deadline` limit the whole of the parse,
+    not each block."""
+    if profile is True:
+        with _profiled() as profile:
+            for node in iter_blocks(source, packrat, typed, profile,
+                                    max_steps, deadline):
+                yield node
+        return
+    budget = _make_budget(max_steps, deadline)
+    def parse_chunk(chunk):
+        context = _make_context(packrat, profile, budget)
+        return _parse_text(chunk, body, context)[1:]
+    for _, nodes in _iter_parsed(_iter_chunks(source), parse_chunk):
+        for node in nodes:
+            if typed:
+                node = Node.from_list(node)
+            yield node
+
+def iter_html(source, packrat=False, profile=None, max_steps=None,
+              deadline=None):
+    """Yield the HTML for `source` a top level block at a time.  Joined
+    together, the pieces are the same as to_html() of the whole text."""
+    pieces = []
+    writer = StrippedWriter(pieces.append)
+    for node in iter_blocks(source, packrat=packrat, profile=profile,
+                            max_steps=max_steps, deadline=deadline):
+        emit_node(node, writer)
+        if pieces:
+            yield "".join(pieces)
+            del pieces[:]
+
+Block = collections.namedtuple('Block', 'text nodes html')
+
+class IncrementalDocument(object):
+    """A document kept parsed and rendered a block at a time, so that an
+    edit only has to re-parse the blocks it touches.
+
+    The text is split into blocks the same way as for iter_blocks(), which
+    keeps a whole list together in one block.  The HTML of a block is None
+    if it is only blank lines.
+    """
+
+    def __init__(self, text=""):
+        self.text = text
+        self.blocks = []
+        self._starts = []
+        position = 0
+        for chunk, nodes in _iter_parsed(_iter_chunks(text), self._parse):
+            self.blocks.append(self._render(chunk, nodes))
+            self._starts.append(position)
+            position += len(chunk)
+
+    @property
+    def html(self):
+        return "\n".join(
+            block.html for block in self.blocks
+            if block.html is not None).strip()
+
+    def _parse(self, chunk):
+        return parse(chunk)[1:]
+
+    def _render(self, chunk, nodes):
+        lines = []
+        emit_nodes(nodes, lines.append)
+        if not lines:
+            return Block(chunk, nodes, None)
+        return Block(chunk, nodes, "\n".join(lines))
+
+    def apply_edit(self, start, end, new_text):
+        """Replace text[start:end] with `new_text`.
+
+        Returns the new HTML and the change to the blocks, as the index of
+        the first changed block, the number of blocks that were replaced
+        from there and the HTML of the blocks that replaced them.
+        """
+        text = self.text[:start] + new_text + self.text[end:]
+        shift = len(new_text) - (end - start)
+        old, starts = self.blocks, self._starts
+        # The edit can join on to the block before the one it starts in, but
+        # nothing earlier than that changes.  Once a new block ends where an
+        # old one past the edit started, the rest are the same as before.
+        first = max(bisect.bisect_right(starts, start) - 2, 0)
+        last = bisect.bisect_right(starts, end)
+        reusable = dict((block.text, block) for block in old[first:last])
+
+        def parse_chunk(chunk):
+            if chunk in reusable:
+                return reusable[chunk].nodes
+            return self._parse(chunk)
+
+        position = starts[first] if starts else 0
+        size = 64 * 1024
+        pieces = (text[i:i + size] for i in xrange(position, len(text), size))
+        inserted = []
+        inserted_starts = []
+        stop = len(old)
+        for chunk, nodes in _iter_parsed(_iter_chunks(pieces), parse_chunk):
+            block = reusable.get(chunk)
+            if block is None:
+                block = self._render(chunk, nodes)
+            inserted.append(block)
+            inserted_starts.append(position)
+            position += len(chunk)
+            if position - shift >= end:
+                index = bisect.bisect_left(starts, position - shift)
+                if index < len(starts) and starts[index] == position - shift:
+                    stop = index
+                    break
+
+        # Leave out the blocks at either end that came out the same
+        prefix = 0
+        while (prefix < len(inserted) and first + prefix < stop
+               and inserted[prefix].text == old[first + prefix].text):
+            prefix += 1
+        suffix = 0
+        while (suffix < len(inserted) - prefix
+               and suffix < stop - first - prefix
+               and inserted[-1 - suffix].text == old[stop - 1 - suffix].text):
+            suffix += 1
+
+        self.text = text
+        self.blocks = old[:first] + inserted + old[stop:]
+        self._starts = (starts[:first] + inserted_starts +
+                        [offset + shift for offset in starts[stop:]])
+        changed = inserted[prefix:len(inserted) - suffix]
+        return self.html, (first + prefix, stop - first - prefix - suffix,
+                           [block.html for block in changed])
+
+markdown_extensions = ('.md', '.markdown', '.mdown')
+
+manifest_name = '.markdown3-manifest.json'
+
+def _file_hash(path):
+    import hashlib
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _find_sources(paths):
+    # Yields (source, target) pairs, where target is the path of the HTML
+    # relative to the output directory.
+    import glob
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.endswith(markdown_extensions):
+                        source = os.path.join(dirpath, filename)
+                        yield source, os.path.relpath(source, path)
+            continue
+        for source in sorted(glob.glob(path)) or [path]:
+            target = os.path.relpath(source)
+            if target.startswith(os.pardir):
+                target = os.path.basename(source)
+            yield source, target
+
+def _convert_file(job):
+    source, target = job
+    start = timeit.default_timer()
+    size = 0
+    try:
+        with open(source, 'rb') as f:
+            text = f.read()
+        size = len(text)
+        html = to_html(text) + "\n"
+        if isinstance(html, unicode):
+            html = html.encode('utf-8')
+        _write_atomically(target, html)
+    except Exception as e:
+        return source, size, timeit.default_timer() - start, _describe(e)
+    return source, size, timeit.default_timer() - start, None
+
+def _describe(error):
+    # Some errors, like a bare NoPatternFound, have no message of their own.
+    message = str(error)
+    if not message:
+        return type(error).__name__
+    return "%s: %s" % (type(error).__name__, message)
+
+def _convert_numbered(numbered):
+    index, job = numbered
+    return index, _convert_file(job)
+
+def convert_tree(paths, output_dir, workers=None, force=False, report=None):
+    """Convert the markdown files in `paths` (files, directories or glob
+    patterns) to HTML files under `output_dir`, across `workers` processes.
+
+    Files that haven't changed since they were last converted, according to
+    the manifest kept in `output_dir`, are skipped unless `force` is set or
+    the manifest was written by a different version of markdown3 or of its
+    grammar.  `report` is called with (source, bytes, seconds, error) for
+    every file that is converted, as soon as it is done, and for every path
+    that can't be found.  Returns the number of files converted, the number
+    skipped, the number that failed and the total bytes converted.
+    """
+    import json
+    import multiprocessing
+    manifest_path = os.path.join(output_dir, manifest_name)
+    stamp = {'version': __version__, 'grammar': grammar_fingerprint()}
+    manifest = {}
+    if not force and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            saved = json.load(f)
+        if all(saved.get(field) == value for field, value in stamp.items()):
+            manifest = saved.get('files', {})
+    jobs = []
+    entries = {}
+    skipped = 0
+    failed = 0
+    for source, name in _find_sources(paths):
+        target = os.path.splitext(os.path.join(output_dir, name))[0] + '.html'
+        try:
+            stat = os.stat(source)
+        except OSError as e:
+            if report is not None:
+                report(source, 0, 0.0, _describe(e))
+            failed += 1
+            continue
+        entry = {'mtime': stat.st_mtime, 'size': stat.st_size}
+        previous = manifest.get(name)
+        if previous is not None and os.path.exists(target):
+            if (previous['mtime'], previous['size']) == (
+                    entry['mtime'], entry['size']):
+                entries[name] = previous
+                skipped += 1
+                continue
+            entry['sha1'] = _file_hash(source)
+            if entry['sha1'] == previous.get('sha1'):
+                entries[name] = entry
+                skipped += 1
+                continue
+        else:
+            entry['sha1'] = _file_hash(source)
+        entries[name] = entry
+        jobs.append((source, target, name))
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    file_jobs = [(source, target) for source, target, name in jobs]
+    pool = None
+    if workers <= 1 or len(jobs) < 2:
+        results = (_convert_numbered(job) for job in enumerate(file_jobs))
+    else:
+        pool = multiprocessing.Pool(
+            min(workers, len(jobs)), initializer=compile_grammar)
+        results = pool.imap_unordered(
+            _convert_numbered, enumerate(file_jobs))
+    converted = 0
+    total = 0
+    try:
+        for index, result in results:
+            if report is not None:
+                report(*result)
+            if result[3] is not None:
+                failed += 1
+                del entries[jobs[index][2]]
+            else:
+                converted += 1
+                total += result[1]
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    else:
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.join()
+    stamp['files'] = entries
+    _write_atomically(manifest_path, json.dumps(
+        stamp, indent=1, sort_keys=True).encode('utf-8'))
+    return converted, skipped, failed, total
+
+def _throughput(size, seconds):
+    if not seconds:
+        return "-"
+    return "%.2f MB/s" % (size / seconds / 1e6)
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="python -m markdown3",
+        description="Convert markdown to HTML.  Without --output-dir, each "
+        "file (or standard input) is converted to standard output.")
+    parser.add_argument(
+        'paths', nargs='*', metavar='PATH',
+        help="markdown files, directories or glob patterns")
+    parser.add_argument(
+        '-o', '--output-dir',
+        help="write an HTML file for each markdown file to this directory, "
+        "skipping files that are unchanged since the last run")
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help="number of processes to convert with (default: one per core)")
+    parser.add_argument(
+        '-f', '--force', action='store_true',
+        help="convert every file, even if it hasn't changed")
+    parser.add_argument(
+        '-q', '--quiet', action='store_true',
+        help="don't report on each file converted")
+    args = parser.parse_args(argv)
+
+    if args.output_dir is None:
+        if not args.paths or args.paths == ['-']:
+            sys.stdout.write(to_html(sys.stdin.read()) + "\n")
+            return 0
+        for path in args.paths:
+            with open(path, 'rb') as f:
+                sys.stdout.write(to_html(f.read()) + "\n")
+        return 0
+
+    def report(source, size, seconds, error):
+        if error is not None:
+            sys.stderr.write("%s: %s\n" % (source, error))
+        elif not args.quiet:
+            sys.stderr.write("%s: %d bytes in %.3fs, %s\n" % (
+                source, size, seconds, _throughput(size, seconds)))
+
+    start = timeit.default_timer()
+    converted, skipped, failed, size = convert_tree(
+        args.paths or ['.'], args.output_dir, workers=args.jobs,
+        force=args.force, report=report)
+    seconds = timeit.default_timer() - start
+    sys.stderr.write(
+        "Converted %d files (%d unchanged, %d failed), %d bytes in %.3fs, "
+        "%s\n" % (converted, skipped, failed, size, seconds,
+                  _throughput(size, seconds)))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""Convert markdown from trollius code without blocking the event loop.
+
+Like markdown3, this runs on Python 2, where asyncio comes as trollius and
+its executors as the futures package, both of which it needs::
+
+    pip install trollius futures
+
+The work is done by markdown3 itself, on a bounded executor.  Everything
+here returns futures, to be used with ``yield From(...)``.
+"""
+
+import collections
+import threading
+
+try:
+    import trollius as asyncio
+    import concurrent.futures
+except ImportError:
+    raise ImportError(
+        "markdown3_aio needs trollius and futures: "
+        "pip install trollius futures")
+
+import markdown3
+
+class QueueFull(Exception):
+    pass
+
+def _create_future(loop):
+    return asyncio.Future(loop=loop)
+
+class AsyncRenderer(object):
+    """Runs conversions on `executor`, at most `max_concurrency` at a time.
+
+    Calls beyond that wait their turn in the order they were made.  Once
+    `max_pending` calls are waiting, further calls fail with QueueFull
+    rather than queueing without limit.  Conversions go through `renderer`
+    (a markdown3.Renderer), so they share its cache.
+    """
+
+    def __init__(self, renderer=None, max_concurrency=4, max_pending=None,
+                 executor=None):
+        if renderer is None:
+            renderer = markdown3.Renderer()
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_concurrency)
+        self.renderer = renderer
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self._running = 0
+        self._waiting = collections.deque()
+
+    def _acquire(self, loop):
+        slot = _create_future(loop)
+        if self._running < self.max_concurrency:
+            self._running += 1
+            slot.set_result(None)
+        elif (self.max_pending is not None
+              and len(self._waiting) >= self.max_pending):
+            raise QueueFull()
+        else:
+            self._waiting.append(slot)
+        return slot
+
+    def _release(self):
+        while self._waiting:
+            slot = self._waiting.popleft()
+            if not slot.cancelled():
+                slot.set_result(None)
+                return
+        self._running -= 1
+
+    def run(self, func, *args):
+        """Call func(*args) on the executor once there is room, returning a
+        future for the result.  Cancelling the future before the call has
+        started stops it from running."""
+        loop = asyncio.get_event_loop()
+        result = _create_future(loop)
+        slot = self._acquire(loop)
+        jobs = []
+
+        def finished(job):
+            loop.call_soon_threadsafe(self._release)
+            loop.call_soon_threadsafe(set_result, job)
+
+        def set_result(job):
+            if result.cancelled():
+                return
+            if job.cancelled():
+                result.cancel()
+            elif job.exception() is not None:
+                result.set_exception(job.exception())
+            else:
+                result.set_result(job.result())
+
+        def start(slot):
+            if slot.cancelled():
+                return
+            if result.cancelled():
+                self._release()
+                return
+            job = self.executor.submit(func, *args)
+            jobs.append(job)
+            job.add_done_callback(finished)
+
+        def cancelled(result):
+            if not result.cancelled():
+                return
+            if jobs:
+                jobs[0].cancel()
+            else:
+                slot.cancel()
+
+        slot.add_done_callback(start)
+        result.add_done_callback(cancelled)
+        return result
+
+    def to_html(self, text, pattern=markdown3.body, timeout=None):
+        """Return an awaitable for to_html(text), which is cancelled and
+        raises asyncio.TimeoutError if it takes longer than `timeout`
+        seconds."""
+        result = self.run(self.renderer.to_html, text, pattern)
+        if timeout is not None:
+            return asyncio.wait_for(result, timeout)
+        return result
+
+    def iter_html(self, text):
+        """Return an HTMLStream of the HTML of `text`, a top level block at
+        a time, rendered by `renderer`."""
+        return HTMLStream(self, self.renderer.iter_html(text))
+
+class HTMLStream(object):
+    """The HTML of a document, rendered a piece at a time on the executor
+    of an AsyncRenderer as each piece is asked for::
+
+        while True:
+            piece = yield From(stream.next_piece())
+            if piece is None:
+                break
+
+    A piece can be asked for before the last one has arrived, in which case
+    it is only rendered once that one has been, so the futures get the
+    pieces in the order they were asked for.
+    """
+
+    def __init__(self, renderer, pieces):
+        self.renderer = renderer
+        self.pieces = pieces
+        self._lock = threading.Lock()
+        self._last = None
+
+    def _next(self):
+        # Only one executor thread runs at a time, but they needn't be the
+        # same one.
+        with self._lock:
+            return next(self.pieces, None)
+
+    def next_piece(self):
+        """Return a future for the next piece of HTML, or for None once
+        there are no more."""
+        previous = self._last
+        if previous is None or previous.done():
+            piece = self.renderer.run(self._next)
+        else:
+            piece = _create_future(asyncio.get_event_loop())
+            previous.add_done_callback(
+                lambda previous: self._start(piece))
+        self._last = piece
+        return piece
+
+    def _start(self, piece):
+        if piece.cancelled():
+            return
+        try:
+            job = self.renderer.run(self._next)
+        except QueueFull as e:
+            piece.set_exception(e)
+            return
+
+        def done(job):
+            if piece.cancelled():
+                return
+            if job.cancelled():
+                piece.cancel()
+            elif job.exception() is not None:
+                piece.set_exception(job.exception())
+            else:
+                piece.set_result(job.result())
+
+        def cancelled(piece):
+            if piece.cancelled():
+                job.cancel()
+
+        job.add_done_callback(done)
+        piece.add_done_callback(cancelled)
+
+_default = None
+
+def _default_renderer():
+    global _default
+    if _default is None:
+        _default = AsyncRenderer()
+    return _default
+
+def to_html(text, pattern=markdown3.body, timeout=None):
+    return _default_renderer().to_html(text, pattern, timeout)
+
+def iter_html(text):
+    return _default_renderer().iter_html(text)
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import StringIO
+
 import pegger as pg
 
 import markdown3 as md
@@ -182,3 +184,115 @@ def test_numbered_bullet():
 
     result = pg.parse_string(data, ordered_list)
     assert expected == result
+
+def test_render_to():
+    data = """
+# A Header
+
+A paragraph with *some bold* and [a link to Google](http://www.google.com) in it.
+
+* A numbered bullet
+  * A bullet in a sublist
+* A bullet with `code` in the first list
+
+---
+
+> A quoted paragraph
+"""
+    out = StringIO.StringIO()
+    md.render_to(data, out)
+    assert md.to_html(data) == out.getvalue()
+
+    tree = md.parse(data)
+    out = StringIO.StringIO()
+    md.render_to(tree, out)
+    assert md.to_html(data) == out.getvalue()
+
+    data = [
+        'ordered_list',
+        ['list_item', "A bullet"]]
+    out = StringIO.StringIO()
+    md.render_to(data, out)
+    assert md.htmlise(data).strip() == out.getvalue()
+
+def test_htmlise_node():
+    data = [
+        'ordered_list',
+        ['list_item',
+         ['plain',
+          "A bullet with some ",
+          ['emphasis', "bold"],
+          " in it"]],
+        ['list_item',
+         ['link',
+          ['link_text', "a link to Google"],
+          ['link_url', "http://www.google.com"]]]]
+    node = md.Node.from_list(data)
+    assert data == node.to_list()
+    assert md.htmlise(data) == md.htmlise(node)
+
+def test_build_opcodes():
+    data = ['paragraph', ['emphasis', "Some bold"]]
+    assert "<p><strong>Some bold</strong></p>\n" == md.htmlise(data)
+    md.lookups['emphasis'] = "em"
+    try:
+        assert "<p><em>Some bold</em></p>\n" == md.htmlise(data)
+    finally:
+        md.lookups['emphasis'] = "strong"
+    assert "<p><strong>Some bold</strong></p>\n" == md.htmlise(data)
+
+    def make_custom(head, rest):
+        return ["CUSTOM"]
+    md.tag_funcs['emphasis'] = make_custom
+    try:
+        assert "<p>CUSTOM</p>\n" == md.htmlise(data)
+    finally:
+        md.tag_funcs['emphasis'] = md.make_span
+    assert "<p><strong>Some bold</strong></p>\n" == md.htmlise(data)
+
+def test_htmlise_deep_tree():
+    depth = 5000
+    data = ['bullet_without_paragraph', ['plain', "The deepest bullet"]]
+    for _ in range(depth):
+        data = ['unordered_list', data]
+    lines = md.do_render(data)
+    assert "<ul>" == lines[0]
+    assert "  " * depth + "<li>The deepest bullet</li>" in lines
+    assert "</ul>" == lines[-2]
+
+    node = md.Node.from_list(data)
+    assert lines == md.do_render(node)
+    assert lines == md.do_render(node.to_list())
+
+def test_backends():
+    data = [
+        'body',
+        ['title_level_1', "A Header"],
+        ['paragraph',
+         ['plain', "A paragraph with "],
+         ['emphasis', "some bold"],
+         ['plain', " and "],
+         ['link',
+          ['link_text', "a link to Google"],
+          ['link_url', "http://www.google.com"]]],
+        ['unordered_list',
+         ['bullet_without_paragraph', ['plain', "A bullet"]],
+         ['bullet_without_paragraph', ['plain', "Another bullet"]]],
+        ['code_block', ['code_line', "&lt;p&gt;Some html&lt;/p&gt;"]],
+        ['horizontal_rule', "---"]]
+    html, text, tree = md.walk(
+        data, md.HTMLBackend(), md.TextBackend(), md.JSONBackend())
+    assert md.htmlise(data) == html
+    assert md.htmlise(data) == md.walk(md.Node.from_list(data),
+                                       md.HTMLBackend())[0]
+    assert text == """
+A Header
+A paragraph with some bold and a link to Google
+A bullet
+Another bullet
+<p>Some html</p>
+---
+""".strip()
+    assert tree.startswith(
+        '{"type": "body", "children": [{"type": "title_level_1", '
+        '"children": ["A Header"]}')
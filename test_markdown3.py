@@ -1,5 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import json
+import logging
+import mmap
+import os
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 
 import markdown3
@@ -775,6 +785,43 @@ def test_code_block():
     assert expected == result
 
 
+def without_scanners(func, *args, **kwargs):
+    scanners = dict(markdown3.scanners)
+    markdown3.scanners.clear()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        markdown3.scanners.update(scanners)
+
+def test_long_code_block():
+    data = "A paragraph\n\n" + "    <b>line</b> & more\n" * 2000
+    expected = "\n\n".join(
+        ["<p>A paragraph</p>"] +
+        ["<code>\n  &lt;b&gt;line&lt;/b&gt; &amp; more\n</code>"] * 2000)
+    assert expected == markdown3.to_html(data)
+
+    chunks = list(markdown3._iter_chunks(data, code_chunk_size=1024))
+    assert len(chunks) > 40
+    assert max(len(chunk) for chunk in chunks) < 1100
+    assert expected == "".join(markdown3.iter_html(data))
+
+def test_code_block_scanners():
+    # The scanners match code blocks without going through pegger, so they
+    # have to come up with just what the grammar does on its own.
+    texts = [
+        "    <b>line</b> & more\n" * 50,
+        "\tA tabbed line\n\t\tTwo tabs\n \tMixed\n",
+        "    A line\n\n    After a blank line\n\n\n    And two\n",
+        "    Trailing spaces   \n    Trailing tab\t\n    \n",
+        "A paragraph\n\n    Some code\n  * A bullet\n    More code\n",
+        "    Some code\n1. A bullet\n\n    More code",
+        "        Deeper\n    Shallower\n",
+        ]
+    for data in texts:
+        assert without_scanners(markdown3.parse, data) == markdown3.parse(data)
+        assert (without_scanners(markdown3.to_html, data) ==
+                markdown3.to_html(data))
+
 def test_horizontal_rules():
     data = """
 ---
@@ -899,3 +946,805 @@ A paragraph with *some bold*, `some code` and [a link to Google](http://www.goog
 
     result = markdown3.to_html(data)
     assert expected == result
+
+
+def test_compile_grammar():
+    pattern = markdown3.compile_grammar()
+    assert pattern is markdown3.body
+    assert markdown3.paragraph() is markdown3.paragraph()
+    assert markdown3.ordered_list() is markdown3.ordered_list()
+
+    data = "Hello *World*"
+    expected = [
+        'body',
+        ['paragraph',
+         ['plain', "Hello "],
+         ['emphasis', "World"]]]
+    assert expected == markdown3.parse(data)
+    assert expected == markdown3.parse(data)
+
+
+def test_packrat():
+    data = """
+1. A numbered bullet
+  2. A bullet in a sublist
+    * A bullet in a third list
+  3. A bullet with *bold* in a sublist
+
+4. A bullet with `code` in the first list
+"""
+    expected = markdown3.parse(data)
+    cache = markdown3.PackratCache()
+    result = markdown3.parse(data, packrat=cache)
+    assert expected == result
+    assert len(cache) > 0
+    assert markdown3.to_html(data) == markdown3.to_html(data, packrat=True)
+
+
+def test_packrat_cache_eviction():
+    cache = markdown3.PackratCache(max_entries=2)
+    cache.put(('rule', None, 5), 'first')
+    cache.put(('rule', None, 4), 'second')
+    assert cache.get(('rule', None, 5)) == 'first'
+    cache.put(('rule', None, 3), 'third')
+    assert len(cache) == 2
+    assert cache.get(('rule', None, 5)) == 'first'
+    try:
+        cache.get(('rule', None, 4))
+    except KeyError:
+        pass
+    else:
+        assert False, "Least recently used entry should have been evicted"
+
+
+def test_parse_hook():
+    do_parse = markdown3.pg.do_parse
+    markdown3.parse("* A bullet\n* Another bullet", packrat=True)
+    assert markdown3.pg.do_parse is do_parse
+
+
+def test_iter_blocks():
+    data = """
+# A Header
+
+## A SubHeader ##
+
+A paragraph with *some bold*, `some code` and [a link to Google](http://www.google.com) in it.
+
+---
+
+ 1. A bullet in a list
+ 2. Another bullet
+   * A sublist bullet
+   * Another sublist bullet
+ 3. A bullet in the first list
+
+  A code block with <span>some html</span> in it.
+
+1. A bullet
+
+2. Another bullet
+
+> A quoted paragraph
+"""
+    expected = markdown3.parse(data)
+
+    result = ['body'] + list(markdown3.iter_blocks(data))
+    assert expected == result
+
+    result = ['body'] + list(markdown3.iter_blocks(StringIO.StringIO(data)))
+    assert expected == result
+
+    pieces = [data[i:i+7] for i in range(0, len(data), 7)]
+    result = ['body'] + list(markdown3.iter_blocks(iter(pieces)))
+    assert expected == result
+
+
+def test_iter_blocks_split_span():
+    data = """A [link
+
+to Google](http://www.google.com) in it.
+
+A paragraph
+"""
+    expected = markdown3.parse(data)
+    result = ['body'] + list(markdown3.iter_blocks(data))
+    assert expected == result
+
+    html = markdown3.to_html(data)
+    assert html == "".join(markdown3.iter_html(data))
+    assert html == markdown3.to_html(data, degrade=True)
+    assert html == markdown3.IncrementalDocument(data).html
+
+    # The list carries on past the blank line after the link
+    data = "* A [link\n\nto Google](http://www.google.com)\n\n* A bullet\n"
+    expected = markdown3.parse(data)
+    assert expected == ['body'] + list(markdown3.iter_blocks(data))
+    html = markdown3.to_html(data)
+    assert html == "".join(markdown3.iter_html(data))
+    assert html == markdown3.IncrementalDocument(data).html
+
+
+def test_iter_html():
+    data = """
+# A Header
+
+A paragraph with *some bold*.
+
+* A bullet
+* Another bullet
+
+    A code block
+"""
+    pieces = list(markdown3.iter_html(data))
+    assert len(pieces) == 4
+    assert markdown3.to_html(data) == "".join(pieces)
+
+def test_fused():
+    data = """
+# A Header
+
+A paragraph with *some bold*, `some code` and [a link to Google](http://www.google.com) in it.
+
+1. A bullet
+
+2. Another bullet
+  * A sublist bullet
+
+    A code block with <span>some html</span> in it.
+
+> A quoted paragraph
+"""
+    expected = markdown3.to_html(data)
+    assert expected == markdown3.to_html(data, fused=True)
+
+    out = StringIO.StringIO()
+    markdown3.render_to(data, out, fused=True)
+    assert expected == out.getvalue()
+
+    assert expected == markdown3.to_html(data, fused=True, max_steps=100000)
+    for render in (lambda **kwargs: markdown3.to_html(data, **kwargs),
+                   lambda **kwargs: markdown3.render_to(
+                       data, StringIO.StringIO(), **kwargs)):
+        try:
+            render(fused=True, max_steps=10)
+        except markdown3.ParseLimitExceeded:
+            pass
+        else:
+            assert False, "Expected ParseLimitExceeded"
+        profile = markdown3.Profile()
+        render(fused=True, profile=profile)
+        assert profile.stats['title_level_1'].calls
+
+def test_parse_limits():
+    data = "A paragraph with *some bold*.\n\n* A bullet\n* Another bullet"
+    expected = markdown3.to_html(data)
+    assert expected == markdown3.to_html(data, max_steps=100000)
+    assert expected == markdown3.to_html(data, deadline=60)
+
+    try:
+        markdown3.parse(data, max_steps=10)
+    except markdown3.ParseLimitExceeded:
+        pass
+    else:
+        assert False, "Expected ParseLimitExceeded"
+
+    def count_steps(text):
+        budget = markdown3.ParseBudget()
+        context = markdown3._make_context(budget=budget)
+        markdown3._parse_string(text + "\n\n", markdown3.body, context)
+        return budget.steps
+
+    # Only the block that runs out of steps is escaped
+    paragraph = "A paragraph"
+    bullets = "* A bullet\n* Another bullet"
+    max_steps = count_steps(paragraph)
+    assert max_steps < count_steps(bullets)
+    result = markdown3.to_html(paragraph + "\n\n" + bullets,
+                               max_steps=max_steps, degrade=True)
+    assert result == (
+        "<p>A paragraph</p>\n\n"
+        "<p>* A bullet\n* Another bullet</p>")
+
+def test_buffers():
+    data = """
+# A Header
+
+A paragraph with *some bold*.
+
+* A bullet
+* Another bullet
+"""
+    expected = markdown3.to_html(data)
+    assert expected == markdown3.to_html(bytearray(data))
+    assert expected == markdown3.to_html(memoryview(data))
+    assert markdown3.parse(data) == markdown3.parse(bytearray(data))
+
+    lines = list(markdown3._iter_lines(data))
+    assert lines == list(markdown3._iter_lines(
+        markdown3._iter_buffer(bytearray(data), size=5)))
+
+    with tempfile.TemporaryFile() as f:
+        f.write(data)
+        f.flush()
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            assert expected == markdown3.to_html(mapped)
+        finally:
+            mapped.close()
+
+def test_buffer_options():
+    data = "A paragraph\n\n* A bullet\n* Another bullet\n"
+    buffer = bytearray(data)
+    for convert in (markdown3.parse, markdown3.to_html):
+        try:
+            convert(buffer, max_steps=10)
+        except markdown3.ParseLimitExceeded:
+            pass
+        else:
+            assert False, "Expected ParseLimitExceeded"
+        try:
+            convert(buffer, pattern=markdown3.paragraph)
+        except ValueError:
+            pass
+        else:
+            assert False, "Expected ValueError"
+    directory = tempfile.mkdtemp()
+    try:
+        markdown3.parse(buffer, cache=markdown3.ParseCache(directory))
+    except ValueError:
+        pass
+    else:
+        assert False, "Expected ValueError"
+    finally:
+        shutil.rmtree(directory)
+
+    assert markdown3.parse(buffer, max_steps=100000) == markdown3.parse(data)
+    assert (markdown3.to_html(buffer, max_steps=10, degrade=True) ==
+            markdown3.to_html(data, max_steps=10, degrade=True))
+
+    profile = markdown3.Profile()
+    markdown3.to_html(buffer, profile=profile)
+    assert profile.stats['paragraph'].calls
+
+def test_to_html_many():
+    texts = [
+        "Hello *World*",
+        "# A Header",
+        None,
+        "* A bullet\n* Another bullet",
+        ]
+    expected = [markdown3.to_html(text) for text in texts if text is not None]
+
+    for workers, min_batch in [(1, 64), (2, 0)]:
+        results = markdown3.to_html_many(
+            texts, workers=workers, min_batch=min_batch)
+        assert len(results) == len(texts)
+        assert isinstance(results[2], Exception)
+        del results[2]
+        assert expected == results
+
+
+def test_renderer_cache():
+    cache = markdown3.RenderCache(max_entries=2)
+    renderer = markdown3.Renderer(cache=cache)
+    data = "Hello *World*"
+    expected = markdown3.to_html(data)
+
+    assert expected == renderer.to_html(data)
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert expected == renderer.to_html(data)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    renderer.to_html("# A Header")
+    renderer.to_html("## A SubHeader")
+    assert len(cache) == 2
+    assert cache.get(data) is None
+
+
+def test_renderer_cache_directory():
+    directory = tempfile.mkdtemp()
+    try:
+        data = u"Hello *World*"
+        expected = markdown3.to_html(data)
+        renderer = markdown3.Renderer(
+            cache=markdown3.RenderCache(directory=directory))
+        assert expected == renderer.to_html(data)
+
+        cache = markdown3.RenderCache(directory=directory)
+        result = markdown3.Renderer(cache=cache).to_html(data)
+        assert expected == result
+        assert isinstance(result, unicode)
+        assert (cache.hits, cache.misses) == (1, 0)
+    finally:
+        shutil.rmtree(directory)
+
+def test_renderer_cache_directory_limits():
+    directory = tempfile.mkdtemp()
+    try:
+        def cached():
+            return sorted(name for _, _, names in os.walk(directory)
+                          for name in names)
+
+        cache = markdown3.RenderCache(directory=directory,
+                                      max_disk_entries=3)
+        keys = []
+        for when, text in enumerate(["One", "Two", "Three"]):
+            cache.put(text, markdown3.body, markdown3.to_html(text))
+            keys.append(cache.key(text))
+            os.utime(cache._disk.path(keys[-1]), (when, when))
+        assert cached() == sorted(keys)
+
+        # Reading "One" from the disk marks it as recently used, so "Two"
+        # and "Three" go once a fourth entry takes it over the limit.
+        cache = markdown3.RenderCache(directory=directory,
+                                      max_disk_entries=3)
+        assert cache.get("One") == "<p>One</p>"
+        cache.put("Four", markdown3.body, "<p>Four</p>")
+        assert cached() == sorted([keys[0], cache.key("Four")])
+
+        cache = markdown3.RenderCache(directory=directory, max_disk_bytes=1)
+        cache.put("Five", markdown3.body, "<p>Five</p>")
+        assert cached() == []
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_parse_cache():
+    directory = tempfile.mkdtemp()
+    try:
+        data = "Hello *World*"
+        expected = markdown3.parse(data)
+        cache = markdown3.ParseCache(directory)
+        assert expected == markdown3.parse(data, cache=cache)
+        assert (cache.hits, cache.misses) == (0, 1)
+
+        cache = markdown3.ParseCache(directory)
+        assert expected == markdown3.parse(data, cache=cache)
+        assert (cache.hits, cache.misses) == (1, 0)
+        typed = markdown3.parse(data, typed=True, cache=cache)
+        assert expected == typed.to_list()
+
+        cache.fingerprint = "a changed grammar"
+        assert cache.get(data) is None
+
+        cache = markdown3.ParseCache(directory, max_bytes=1)
+        markdown3.parse("# A Header", cache=cache)
+        assert cache.get("# A Header") is None
+        assert not any(files for _, _, files in os.walk(directory))
+    finally:
+        shutil.rmtree(directory)
+
+def test_grammar_fingerprint():
+    fingerprint = markdown3.grammar_fingerprint()
+    markdown3.to_html("A paragraph\n\n    A code block\n\n* A bullet")
+    assert fingerprint == markdown3.grammar_fingerprint()
+
+    directory = tempfile.mkdtemp()
+    scan_code_block = markdown3.scanners[markdown3.code_block]
+    inline_token = markdown3._inline_token
+    version = markdown3.__version__
+    try:
+        data = "    A code block"
+        cache = markdown3.ParseCache(directory)
+        markdown3.parse(data, cache=cache)
+        assert cache.get(data) is not None
+
+        def scan_nothing(text):
+            return None
+        markdown3.scanners[markdown3.code_block] = scan_nothing
+        assert fingerprint != markdown3.grammar_fingerprint()
+        assert markdown3.ParseCache(directory).get(data) is None
+        markdown3.scanners[markdown3.code_block] = scan_code_block
+
+        markdown3._inline_token = markdown3.re.compile(r"[^*`\[]+")
+        assert fingerprint != markdown3.grammar_fingerprint()
+        markdown3._inline_token = inline_token
+
+        markdown3.__version__ += ".1"
+        assert fingerprint != markdown3.grammar_fingerprint()
+    finally:
+        markdown3.scanners[markdown3.code_block] = scan_code_block
+        markdown3._inline_token = inline_token
+        markdown3.__version__ = version
+        shutil.rmtree(directory)
+    assert fingerprint == markdown3.grammar_fingerprint()
+
+def test_renderer_threads():
+    texts = [
+        "Hello *World*",
+        "# A Header\n\nA paragraph with `some code`",
+        "* A bullet\n* Another bullet",
+        "1. A numbered bullet\n2. Another numbered bullet",
+        ] * 25
+    expected = [markdown3.to_html(text) for text in texts]
+    renderer = markdown3.Renderer(
+        cache=markdown3.RenderCache(max_entries=2), packrat=True)
+    results = {}
+
+    def render(index):
+        results[index] = [renderer.to_html(text) for text in texts]
+
+    threads = [
+        threading.Thread(target=render, args=(i,)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [expected] * 16 == [results[i] for i in range(16)]
+
+
+def test_renderer_tables():
+    lookups = dict(markdown3.lookups, emphasis="em")
+    renderer = markdown3.Renderer(lookups=lookups)
+    assert "<p>Hello <em>World</em></p>" == renderer.to_html("Hello *World*")
+    assert "<p>Hello <strong>World</strong></p>" == markdown3.to_html(
+        "Hello *World*")
+
+    tag_funcs = dict(markdown3.tag_funcs)
+    del tag_funcs['emphasis']
+    renderer = markdown3.Renderer(tag_funcs=tag_funcs)
+    assert "<p>Hello <strong>World</strong></p>" == renderer.to_html(
+        "Hello *World*")
+    assert 'emphasis' not in renderer.opcodes
+
+    # Renderers with different tables can share a cache.
+    cache = markdown3.RenderCache()
+    assert "<p>Hello <strong>World</strong></p>" == markdown3.Renderer(
+        cache=cache).to_html("Hello *World*")
+    assert "<p>Hello <em>World</em></p>" == markdown3.Renderer(
+        cache=cache, lookups=lookups).to_html("Hello *World*")
+    assert (cache.hits, cache.misses) == (0, 2)
+
+def test_renderer_buffer():
+    data = "# A Header\n\nHello *World*\n\n* A bullet\n* Another bullet\n"
+    renderer = markdown3.Renderer(cache=markdown3.RenderCache())
+    assert markdown3.to_html(bytearray(data)) == renderer.to_html(
+        bytearray(data))
+    assert markdown3.parse(data) == renderer.parse(memoryview(data))
+    with tempfile.TemporaryFile() as f:
+        f.write(data)
+        f.flush()
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            assert markdown3.to_html(data) == renderer.to_html(mapped)
+        finally:
+            mapped.close()
+    assert len(renderer.cache) == 0
+    for convert in (renderer.parse, renderer.to_html):
+        try:
+            convert(bytearray(data), markdown3.paragraph)
+        except ValueError:
+            pass
+        else:
+            assert False, "Expected ValueError"
+
+def test_typed_tree():
+    data = """
+# A Header
+
+A paragraph with *some bold*, `some code` and [a link to Google](http://www.google.com) in it.
+
+1. A numbered bullet
+  2. A bullet in a sublist
+3. A bullet with `code` in the first list
+
+---
+"""
+    expected = markdown3.parse(data)
+    result = markdown3.parse(data, typed=True)
+    assert isinstance(result, markdown3.Node)
+    assert result.kind == 'body'
+    assert expected == result.to_list()
+
+    title = result.children[0]
+    assert (title.kind, title.text) == ('title_level_1', "A Header")
+
+    assert markdown3.htmlise(expected) == markdown3.htmlise(result)
+
+    blocks = list(markdown3.iter_blocks(data, typed=True))
+    assert expected[1:] == [block.to_list() for block in blocks]
+
+    assert expected == markdown3.Node.from_list(expected).to_list()
+    try:
+        markdown3.parse(data, typed=True, max_steps=10)
+    except markdown3.ParseLimitExceeded:
+        pass
+    else:
+        assert False, "Expected ParseLimitExceeded"
+
+
+def test_profile():
+    data = """
+1. A numbered bullet
+2. A bullet with *bold*
+"""
+    profile = markdown3.Profile()
+    result = markdown3.parse(data, profile=profile)
+    assert markdown3.parse(data) == result
+
+    stats = profile.stats['numbered_bullet_without_paragraph']
+    assert stats.successes >= 2
+    assert stats.calls == stats.successes + stats.failures
+    assert profile.stats['body'].calls == 1
+    assert profile.stats['body'].seconds >= stats.seconds
+
+    report = profile.report(limit=3).splitlines()
+    assert len(report) == 4
+    assert report[1].startswith("body ")
+
+    with markdown3.profiling() as profile:
+        markdown3.to_html(data)
+        markdown3.to_html(data)
+    assert profile.stats['body'].calls == 2
+
+def test_profile_logging():
+    data = "1. A numbered bullet\n2. A bullet with *bold*\n"
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    logger = logging.getLogger("markdown3")
+    logger.addHandler(handler)
+    level = logger.level
+    logger.setLevel(logging.INFO)
+    try:
+        assert markdown3.parse(data) == markdown3.parse(data, profile=True)
+        assert (markdown3.to_html(data) ==
+                markdown3.to_html(data, profile=True) ==
+                markdown3.to_html(data, profile=True, degrade=True))
+        assert (list(markdown3.iter_blocks(data)) ==
+                list(markdown3.iter_blocks(data, profile=True)))
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+    assert len(records) == 4
+    for record in records:
+        assert "numbered_bullet_without_paragraph" in record.getMessage()
+
+    try:
+        markdown3.parse(data, profile="yes")
+    except TypeError:
+        pass
+    else:
+        assert False, "Expected TypeError"
+
+
+def test_scan_span_text():
+    data = "Text with *some bold*, `some code` and [a link](http://www.google.com) in it\nNext"
+    expected = [
+        ['plain', "Text with "],
+        ['emphasis', "some bold"],
+        ['plain', ", "],
+        ['code', "some code"],
+        ['plain', " and "],
+        ['link',
+         ['link_text', "a link"],
+         ['link_url', "http://www.google.com"]],
+        ['plain', " in it"]]
+    nodes, end = markdown3.scan_span_text(data)
+    assert expected == nodes
+    assert data[end:] == "\nNext"
+
+    # Anything the scanner isn't sure about is left to the full rules
+    assert markdown3.scan_span_text("Text with *unclosed bold\n") is None
+    assert markdown3.scan_span_text("[a link\nover two lines](http://www.google.com)") is None
+    assert markdown3.scan_span_text("\nText") is None
+
+    data = "Text with [a link\nover two lines](http://www.google.com) in it"
+    expected = markdown3.parse(data)
+    scanners = dict(markdown3.scanners)
+    markdown3.scanners.clear()
+    try:
+        assert expected == markdown3.parse(data)
+    finally:
+        markdown3.scanners.update(scanners)
+
+
+def test_first_set():
+    samples = [
+        "# A Header",
+        "## A SubHeader",
+        "---",
+        "* * *",
+        "1. A bullet",
+        "* A bullet",
+        "  * An indented bullet",
+        "    A code block",
+        "A paragraph",
+        "> A quoted paragraph",
+        ]
+    for block in markdown3.blocks:
+        first = markdown3.first_set(block)
+        for data in samples:
+            try:
+                markdown3.parse(data, block)
+            except Exception:
+                continue
+            assert first is None or data[0] in first, (block, data)
+
+    table, default = markdown3.dispatch_table(markdown3.blocks)
+    assert markdown3.title_level_1 in table.get("#", default)
+
+
+def test_body_dispatch():
+    data = """
+# A Header
+
+A paragraph with *some bold*.
+
+---
+
+ 1. A bullet in a list
+   * A sublist bullet
+ 2. A bullet in the first list
+
+  A code block with <span>some html</span> in it.
+
+> A quoted paragraph
+"""
+    expected = markdown3.parse(data)
+    del markdown3.scanners[markdown3.body]
+    try:
+        assert expected == markdown3.parse(data)
+    finally:
+        markdown3.scanners[markdown3.body] = markdown3._scan_body
+
+
+def test_incremental_document():
+    data = """
+# A Header
+
+A paragraph with *some bold*.
+
+1. A numbered bullet
+2. Another numbered bullet
+
+> A quoted paragraph
+"""
+    document = markdown3.IncrementalDocument(data)
+    assert markdown3.to_html(data) == document.html
+
+    start = data.index("some bold")
+    end = start + len("some")
+    html, (index, removed, inserted) = document.apply_edit(
+        start, end, "a little")
+    data = data[:start] + "a little" + data[end:]
+    assert markdown3.to_html(data) == html
+    assert removed == 1
+    assert inserted == [
+        "<p>A paragraph with <strong>a little bold</strong>.</p>\n"]
+    assert document.blocks[index].nodes == [
+        ['paragraph',
+         ['plain', "A paragraph with "],
+         ['emphasis', "a little bold"],
+         ['plain', "."]]]
+
+    # Adding a bullet re-renders the whole list
+    start = data.index("> A quoted")
+    html, (index, removed, inserted) = document.apply_edit(
+        start - 1, start - 1, "3. A third bullet\n")
+    data = data[:start - 1] + "3. A third bullet\n" + data[start - 1:]
+    assert markdown3.to_html(data) == html
+    assert removed == 1
+    assert len(inserted) == 1
+    assert "<li>A third bullet</li>" in inserted[0]
+
+    # Removing the blank line between two blocks merges them
+    start = data.index("\n\n> A quoted")
+    html, _ = document.apply_edit(start, start + 1, "")
+    data = data[:start] + data[start + 1:]
+    assert markdown3.to_html(data) == html
+
+    # A failed edit leaves the document as it was
+    blocks = list(document.blocks)
+    try:
+        document.apply_edit(0, 0, "[broken ")
+    except markdown3.pg.NoPatternFound:
+        pass
+    else:
+        assert False, "Expected NoPatternFound"
+    assert document.text == data
+    assert document.blocks == blocks
+
+def test_incremental_document_locality():
+    class CountingDocument(markdown3.IncrementalDocument):
+        def _parse(self, chunk):
+            parsed.append(chunk)
+            return markdown3.IncrementalDocument._parse(self, chunk)
+
+    data = "".join("Paragraph %s\n\n" % i for i in range(100))
+    parsed = []
+    document = CountingDocument(data)
+    assert len(parsed) == 100
+
+    parsed = []
+    start = data.index("Paragraph 50")
+    html, (index, removed, inserted) = document.apply_edit(
+        start, start + len("Paragraph"), "Edited")
+    data = data[:start] + "Edited" + data[start + len("Paragraph"):]
+    assert markdown3.to_html(data) == html
+    assert parsed == ["Edited 50\n\n"]
+    assert (index, removed, inserted) == (50, 1, ["<p>Edited 50</p>\n"])
+    assert document.text == data
+
+
+def test_convert_tree():
+    directory = tempfile.mkdtemp()
+    try:
+        source = os.path.join(directory, "docs")
+        output = os.path.join(directory, "html")
+        os.makedirs(os.path.join(source, "sub"))
+        texts = {
+            "index.md": "# A Header\n\nHello *World*",
+            os.path.join("sub", "list.md"): "* A bullet\n* Another bullet",
+            }
+        for name, text in texts.items():
+            with open(os.path.join(source, name), 'w') as f:
+                f.write(text)
+
+        reported = []
+        result = markdown3.convert_tree(
+            [source], output, workers=1,
+            report=lambda *args: reported.append(args))
+        assert result == (2, 0, 0, sum(len(text) for text in texts.values()))
+        assert [error for _, _, _, error in reported] == [None, None]
+        for name, text in texts.items():
+            target = os.path.splitext(os.path.join(output, name))[0] + ".html"
+            with open(target) as f:
+                assert markdown3.to_html(text) + "\n" == f.read()
+
+        # Only the file that changed is converted again
+        with open(os.path.join(source, "index.md"), 'a') as f:
+            f.write("\n\nAnother paragraph")
+        result = markdown3.convert_tree([source], output, workers=1)
+        assert result[:3] == (1, 1, 0)
+
+        # Everything is converted again once the grammar changes
+        manifest_path = os.path.join(output, markdown3.manifest_name)
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        assert sorted(manifest['files']) == sorted(texts)
+        manifest['grammar'] = "a changed grammar"
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        reported = []
+        result = markdown3.convert_tree(
+            [source], output, workers=2,
+            report=lambda *args: reported.append(args))
+        assert result[:3] == (2, 0, 0)
+        assert (sorted(path for path, _, _, _ in reported) ==
+                sorted(os.path.join(source, name) for name in texts))
+        result = markdown3.convert_tree([source], output, workers=2)
+        assert result[:3] == (0, 2, 0)
+
+        # Failures say what went wrong, and missing paths count as failures
+        with open(os.path.join(source, "broken.md"), 'w') as f:
+            f.write("[A link that never closes")
+        missing = os.path.join(directory, "missing.md")
+        reported = []
+        result = markdown3.convert_tree(
+            [source, missing], output, workers=1,
+            report=lambda *args: reported.append(args))
+        assert result[:3] == (0, 2, 2)
+        errors = dict((path, error) for path, _, _, error in reported)
+        assert errors[os.path.join(source, "broken.md")].startswith(
+            "NoPatternFound")
+        assert errors[missing].startswith("OSError: ")
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_lazy_import():
+    # Nothing is built, and pegger is left alone, until it's needed.
+    code = (
+        "import sys, markdown3\n"
+        "assert 'pegger' not in sys.modules\n"
+        "assert not markdown3.opcodes and not markdown3._body_dispatch\n"
+        "assert not markdown3._grammar\n"
+        "assert 'match' not in vars(markdown3._inline_token)\n"
+        "assert markdown3.to_html('Hello') == '<p>Hello</p>'\n"
+        "import pegger\n"
+        "assert markdown3.pg is pegger\n"
+        "assert pegger.do_parse is markdown3._pegger_do_parse\n"
+        "assert markdown3.opcodes\n")
+    subprocess.check_call([sys.executable, "-c", code])
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import markdown3
+import markdown3_aio
+from markdown3_aio import asyncio
+
+data = """
+# A Header
+
+A paragraph with *some bold*.
+
+* A bullet
+* Another bullet
+"""
+
+def run(func):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(func())
+    finally:
+        loop.close()
+
+
+def test_to_html():
+    renderer = markdown3_aio.AsyncRenderer()
+    expected = markdown3.to_html(data)
+    assert expected == run(lambda: renderer.to_html(data))
+    assert expected == run(lambda: renderer.to_html(data, timeout=10))
+    assert expected == run(lambda: markdown3_aio.to_html(data))
+
+
+def test_iter_html():
+    stream = markdown3_aio.AsyncRenderer().iter_html(data)
+    pieces = []
+
+    def collect():
+        done = asyncio.Future()
+        def add(piece):
+            if piece.result() is None:
+                done.set_result(pieces)
+            else:
+                pieces.append(piece.result())
+                stream.next_piece().add_done_callback(add)
+        stream.next_piece().add_done_callback(add)
+        return done
+
+    run(collect)
+    assert 3 == len(pieces)
+    assert markdown3.to_html(data) == "".join(pieces)
+
+
+def test_concurrency_limit():
+    renderer = markdown3_aio.AsyncRenderer(max_concurrency=1, max_pending=1)
+    release = threading.Event()
+
+    def block():
+        release.wait()
+        return "Finished"
+
+    def calls():
+        first = renderer.run(block)
+        second = renderer.run(markdown3.to_html, "Hello")
+        try:
+            renderer.run(markdown3.to_html, "Hello")
+        except markdown3_aio.QueueFull:
+            pass
+        else:
+            assert False, "Expected QueueFull"
+        second.cancel()
+        release.set()
+        return first
+
+    assert "Finished" == run(calls)
+    assert 0 == renderer._running
+
+
+def test_overlapping_pieces():
+    renderer = markdown3_aio.AsyncRenderer(max_concurrency=4)
+
+    def pieces():
+        for piece in ["One", "Two", "Three"]:
+            time.sleep(0.01)
+            yield piece
+
+    stream = markdown3_aio.HTMLStream(renderer, pieces())
+    results = run(lambda: asyncio.gather(
+        *[stream.next_piece() for _ in range(5)]))
+    assert ["One", "Two", "Three", None, None] == results
+
+    texts = [data * count for count in range(1, 20)]
+    for text in texts:
+        stream = renderer.iter_html(text)
+        results = run(lambda: asyncio.gather(
+            *[stream.next_piece() for _ in range(3 * len(texts) + 2)]))
+        assert markdown3.to_html(text) == "".join(
+            piece for piece in results if piece is not None)
+
+
+def test_iter_html_renderer():
+    renderer = markdown3.Renderer(
+        lookups=dict(markdown3.lookups, emphasis="em"))
+    stream = markdown3_aio.AsyncRenderer(renderer).iter_html(
+        "Some *emphasis*")
+    assert "<p>Some <em>emphasis</em></p>" == run(stream.next_piece)